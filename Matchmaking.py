@@ -2,6 +2,22 @@ import openai
 from openai import OpenAI
 import gspread
 import os
+import random
+import threading
+import time
+import concurrent.futures
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import queue
+import sqlite3
+import sys
+import re
+import numpy as np
+from scipy import sparse
+from scipy.optimize import linear_sum_assignment
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from openai import OpenAI
@@ -26,7 +42,8 @@ from openai import OpenAI
 # 3. Create a new project in PyCharm. Take this file (main.py), and select all. Copy the entire content of this file
 #    into the main.py inside the newly created project.
 # 4. Copy the other attached file, service_account.json to the newly create project by copying and pasting into the
-#    project's directory.
+#    project's directory. Copy us_cities.csv (the cities used to check the distance between mentors and mentees) to
+#    the project's directory as well.
 # 5. You will also need to replace the path to this file with the path on your computer:
 SERVICE_ACCOUNT_FILE_PATH = '/Users/name/Project/pythonProject/Secret Key/'  # <-- Change the actual path to the file
 SERVICE_ACCOUNT_FILE = SERVICE_ACCOUNT_FILE_PATH + 'service_account.json'
@@ -37,11 +54,13 @@ SERVICE_ACCOUNT_FILE = SERVICE_ACCOUNT_FILE_PATH + 'service_account.json'
 #    google-api-python-client
 #    openai
 #    gspread
+#    numpy
+#    scipy
 # 7. Make sure you are using the correct Google spreadsheet. The script is using this spreadsheet:
 #    Link to your spreadsheet questionnaire answers. If you would
 #    like to use a different spreadsheet, please replace the spreadsheet ID to the ID of the spreadsheet you would like
 #    to use, and share the new spreadsheet file with the service account email address.
-#    We will use the Sheet in read only mode
+#    We will use the Sheet in read only mode, unless the results are written back to it (see below)
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
 #    If we would like to access another spreadsheet, we would need to change the spreadsheet ID, and also to share the
 #    new form with the service account email address. The service account email address is placed inside the
@@ -50,6 +69,17 @@ SPREADSHEET_ID = 'LAST_PART_OF_YOUR_SPREADSHEET_URL'
 #    This is the name of the spreadsheet tab that we will access. If you would like to access a different tab, you will
 #    need to change this as well.
 RANGE_NAME = 'Form Responses'
+#    To write the results back to the spreadsheet, run with --write-results. The matches (and the pairs, with --assign)
+#    are written to these tabs, so create them first. The service account will need to be an Editor of the spreadsheet.
+MATCHES_RANGE_NAME = 'Matches'
+PAIRS_RANGE_NAME = 'Pairs'
+WRITE_SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+#    We keep a copy of the spreadsheet in SNAPSHOT_FILE, and if the spreadsheet was not modified since, use the copy
+#    instead of downloading it again. For this, the Google Drive API needs to be enabled for the service account.
+SNAPSHOT_FILE = 'matchmaking_snapshot.json'
+DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive.metadata.readonly']
+#    Very large tabs are read in pages of this many rows
+SHEETS_PAGE_ROWS = 5000
 #
 #    Run the project by clicking the 'Play' button on the upper right side of the PyCharm window. Please wait about 20
 #    seconds to see the first set of results (because getting results from GPT is slow).
@@ -84,73 +114,945 @@ FOCUS_AREA_COL = 36
 ANSWER_Q1_EXPECTATIONS_AND_HOPES_COL = 39
 ANSWER_Q2_ANYTHING_ELSE_COL = 40
 
-# Function to read from the google spreadsheet mentioned above
-def access_spreadsheet():
-    # Authenticate and create the Sheets API service, read only access
-    creds = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=['https://www.googleapis.com/auth/spreadsheets.readonly'])
+# Sending requests to GPT:
+# The model and sampling settings. These are also part of the cache key, so changing them will send all the mentors
+# to GPT again.
+MODEL = "gpt-4o"  # or "gpt-3.5-turbo"
+TEMPERATURE = 0  # Set the temperature to 0
+TOP_P = 1  # Set top_p to 1 for more deterministic output
+# Number of mentors we send to GPT at the same time. Set this to 1 to send the mentors one by one.
+MAX_CONCURRENT_REQUESTS = 8
+# The rate limits of your OpenAI account, see https://platform.openai.com/account/limits
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 30000
+# How many times to retry a request that failed because of the rate limits, and how long to wait between retries
+MAX_RETRIES = 6
+RETRY_BASE_DELAY = 1  # seconds
+RETRY_MAX_DELAY = 60  # seconds
+# The price of the model in dollars per million tokens, see https://openai.com/api/pricing, used to estimate the cost
+# of a run
+PROMPT_TOKEN_PRICE = 2.50
+COMPLETION_TOKEN_PRICE = 10.00
 
-    service = build('sheets', 'v4', credentials=creds)
+# Caching GPT responses:
+# Since temperature is 0, sending the same prompt again gives the same matches, so we keep every response in a local
+# file and reuse it as long as the mentor, the mentees and the prompt did not change. Run with --no-cache to not use
+# the cache at all, or with --refresh to ask GPT again and overwrite the cached responses.
+CACHE_FILE = 'matchmaking_cache.sqlite'
+CACHE_MAX_ENTRIES = 10000
+CACHE_MAX_AGE_DAYS = 90
+# Scores of every mentor and mentee pair GPT already looked at. Run with --incremental to only send GPT the new and
+# edited participants, and merge their scores with the stored ones.
+SCORE_STORE_FILE = 'matchmaking_scores.sqlite'
+
+# Shortlisting mentees:
+# Before sending a mentor to GPT, we rank all the mentees by how similar their answers are to the mentor's (TF-IDF
+# cosine similarity of the columns below), and send only the SHORTLIST_SIZE most similar mentees. This keeps the
+# prompts small for large cohorts. Set SHORTLIST_SIZE to None to send all the mentees. Run with --recall-report to
+# check how many of the matches GPT finds with all the mentees are also in the shortlist.
+SHORTLIST_SIZE = 50
+SHORTLIST_COLS = [OCCUPATION_COL, COMPANY_COL, INDUSTRY_COL, WORK_HISTORY_COL, CAREER_PATH_COL, EDUCATION_COL,
+                  HIGHER_EDUCATION_COL, DEGREE_COL, VALUES_COL, ABOUT_ME_COL, HOBBIES_COL, FOCUS_AREA_COL,
+                  ANSWER_Q1_EXPECTATIONS_AND_HOPES_COL, ANSWER_Q2_ANYTHING_ELSE_COL]
+STOP_WORDS = {"a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "from", "have", "i", "in", "is", "it",
+              "me", "my", "of", "on", "or", "so", "that", "the", "this", "to", "was", "we", "who", "with", "would",
+              "you", "your"}
+
+# Disqualifying by location:
+# A mentor and mentee who live more than MAX_DISTANCE_MILES apart, where either of them only wants to meet in person,
+# can never be matched. Only wanting to meet in person means a meeting type answer like "In person only": it names one
+# of IN_PERSON_WORDS and says "only", and names none of REMOTE_MEETING_WORDS. With LOCATION_FILTER, these pairs are
+# found here, before the prompts are built, so GPT is never sent those mentees for that mentor. The distances come
+# from the coordinates of the participants' city and state in GAZETTEER_FILE (US cities with their metropolitan area,
+# copy it next to this file). Participants in the same metropolitan area count as close. Pairs where a city is not in
+# the gazetteer are still left for GPT to decide. Distances are computed between the distinct cities of the
+# participants, not between every two participants, so their number never grows beyond the size of the gazetteer,
+# however large the cohort is.
+LOCATION_FILTER = True
+MAX_DISTANCE_MILES = 30
+GAZETTEER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'us_cities.csv')
+REMOTE_MEETING_WORDS = ["zoom", "video", "virtual", "online", "remote"]
+IN_PERSON_WORDS = ["in person", "in-person", "face to face", "face-to-face"]
+
+# Splitting large mentee lists:
+# When the prompt for a mentor (the instructions, the mentor and the mentees) is longer than PROMPT_TOKEN_BUDGET tokens,
+# the mentees are split into chunks that fit, every chunk is sent to GPT separately (at the same time), and the best
+# MATCHES_PER_MENTOR matches of all the chunks are merged. With RERANK_CHUNKED_MATCHES, GPT is then asked once more to
+# pick the final matches out of the best mentees of all the chunks.
+# OpenAI rejects a request larger than the account's TOKENS_PER_MINUTE, so the budget is never more than that, less
+# COMPLETION_TOKEN_ROOM tokens for the response.
+PROMPT_TOKEN_BUDGET = 100000  # gpt-4o can read 128k tokens, we keep some room for the response
+COMPLETION_TOKEN_ROOM = 4000
+MATCHES_PER_MENTOR = 10
+RERANK_CHUNKED_MATCHES = False
+
+# Checking GPT's output:
+# Every line GPT returns is checked against the format in the prompt, and its emails against the mentor and mentees in
+# the prompt. Only the valid lines are printed, and if some lines were wrong, that mentor is sent to GPT again (up to
+# MAX_FORMAT_RETRIES times) to fill in the missing matches. With STREAM_RESPONSES, the matches are printed as GPT
+# writes them, instead of after GPT's whole answer arrived.
+STREAM_RESPONSES = True
+MAX_FORMAT_RETRIES = 1
+
+# Packing mentors:
+# Mentors with the same gender and gender preference have the same compatible mentees (unless some of them are
+# disqualified by location), so when they are sent with all of them (SHORTLIST_SIZE = None, or cohorts small enough
+# that the shortlist has every mentee), most of their prompts are the same. With PACK_MENTORS (or --pack), up to
+# MENTORS_PER_PROMPT mentors with the same mentees are sent to GPT in one prompt, that lists the mentees once and asks
+# for the top matches of every mentor. Run with --pack-report to check how much the packed matches agree with a prompt
+# per mentor.
+PACK_MENTORS = False
+MENTORS_PER_PROMPT = 5
+
+# Pairing mentors and mentees:
+# GPT gives every mentor a list of the best mentees, so the same strong mentee can be on the lists of many mentors.
+# Run with --assign to also pick the final pairs, so that every mentee gets one mentor, every mentor gets at most
+# MENTOR_CAPACITY mentees (or the number in MENTOR_CAPACITIES, by mentor email), and the total score of all the pairs
+# is as high as possible. Pairs in NEVER_PAIR, as (mentor email, mentee email), are never picked.
+MENTOR_CAPACITY = 1
+MENTOR_CAPACITIES = {}
+NEVER_PAIR = []
+
+# Google API services, built once and reused
+google_services = {}
+
+
+def get_google_service(name, version, scopes):
+    key = (name, version, tuple(scopes))
+    if key not in google_services:
+        creds = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=scopes)
+        google_services[key] = build(name, version, credentials=creds)
+    return google_services[key]
+
+
+# The spreadsheet columns the script uses
+def get_spreadsheet_cols():
+    return sorted({ROLE_COL} | {col for name, col, label in PARTICIPANT_FIELDS})
+
+
+# The letter of a spreadsheet column: 0 is A, 25 is Z, 26 is AA
+def column_letter(col):
+    letters = ""
+    col += 1
+    while col:
+        col, remainder = divmod(col - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+# Read only the given columns of the tab, with one batchGet request per SHEETS_PAGE_ROWS rows. Returns the rows like
+# values().get() does, with empty cells in the columns that were not read.
+# The API leaves out the empty cells at the end of a range, so a page that ends with empty rows comes back short even
+# when there are more rows after it. Pages are read until one has no values at all, and the empty rows at the end of
+# the tab are dropped.
+def read_columns(sheets_service, cols, page_rows=None):
+    if page_rows is None:
+        page_rows = SHEETS_PAGE_ROWS
+    rows = []
+    first_row = 1
+    while True:
+        last_row = first_row + page_rows - 1
+        ranges = [f"'{RANGE_NAME}'!{column_letter(col)}{first_row}:{column_letter(col)}{last_row}" for col in cols]
+        result = sheets_service.spreadsheets().values().batchGet(
+            spreadsheetId=SPREADSHEET_ID, ranges=ranges, majorDimension='COLUMNS').execute()
+        columns = [(value_range.get('values') or [[]])[0] for value_range in result.get('valueRanges', [])]
+        page_length = max([len(values) for values in columns], default=0)
+        if page_length == 0:
+            while rows and not any(rows[-1]):
+                rows.pop()
+            return rows
+        for k in range(page_rows):
+            row = [""] * (max(cols) + 1)
+            for col, values in zip(cols, columns):
+                if k < len(values):
+                    row[col] = values[k]
+            rows.append(row)
+        first_row += page_rows
+
+
+# When the spreadsheet was last modified, or None if we can't tell (for example if the Drive API is not enabled)
+def get_modified_time(drive_service):
+    try:
+        return drive_service.files().get(fileId=SPREADSHEET_ID, fields='modifiedTime').execute()['modifiedTime']
+    except Exception as e:
+        print(f"Could not get the spreadsheet's modification time, reading it again: {e}", file=sys.stderr)
+        return None
+
+
+def load_snapshot(snapshot_file):
+    try:
+        with open(snapshot_file, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_snapshot(snapshot_file, modified_time, cols, values):
+    with open(snapshot_file, 'w', encoding='utf-8') as f:
+        json.dump({"spreadsheet_id": SPREADSHEET_ID, "range": RANGE_NAME, "columns": cols,
+                   "modified_time": modified_time, "values": values}, f)
+
+
+# Function to read from the google spreadsheet mentioned above. Only the columns the script uses are read, and if the
+# spreadsheet was not modified since the last run, the copy saved in the snapshot file is used instead.
+def access_spreadsheet(sheets_service=None, drive_service=None, snapshot_file=SNAPSHOT_FILE):
+    if sheets_service is None:
+        sheets_service = get_google_service('sheets', 'v4', SCOPES)
+    cols = get_spreadsheet_cols()
+
+    modified_time = None
+    if snapshot_file:
+        if drive_service is None:
+            drive_service = get_google_service('drive', 'v3', DRIVE_SCOPES)
+        modified_time = get_modified_time(drive_service)
+        snapshot = load_snapshot(snapshot_file)
+        if modified_time is not None and snapshot is not None and \
+                snapshot.get("spreadsheet_id") == SPREADSHEET_ID and snapshot.get("range") == RANGE_NAME and \
+                snapshot.get("columns") == cols and snapshot.get("modified_time") == modified_time:
+            print("The spreadsheet did not change since the last run, using the saved copy", file=sys.stderr)
+            return snapshot["values"]
 
     # Call the Sheets API to get the values
-    sheet = service.spreadsheets()
-    result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=RANGE_NAME).execute()
-    values = result.get('values', [])
+    values = read_columns(sheets_service, cols)
 
     if not values:
         print('No data found.')
     else:
+        if modified_time is not None:
+            save_snapshot(snapshot_file, modified_time, cols, values)
         return values
 
 
-# A function to send input to GPT and get a response
-def get_ai_response(prompt):
+# Write the matches (and the assigned pairs, if given) to their tabs, already split into columns, with a single
+# update request. The tabs need to exist in the spreadsheet.
+def write_results(matches, pairs=None, sheets_service=None):
+    if sheets_service is None:
+        sheets_service = get_google_service('sheets', 'v4', WRITE_SCOPES)
+    header = ["Mentor name", "Mentor email", "Mentee name", "Mentee email", "Overall score", "Occupation",
+              "Education", "Values", "Anything else", "Rationale"]
+    tabs = {MATCHES_RANGE_NAME: [record.to_row() for records in matches for record in records]}
+    if pairs is not None:
+        tabs[PAIRS_RANGE_NAME] = [record.to_row() for record in pairs]
+    values = sheets_service.spreadsheets().values()
+    # Clear the results of the previous run first, in case they had more rows
+    values.batchClear(spreadsheetId=SPREADSHEET_ID, body={"ranges": [f"'{tab}'" for tab in tabs]}).execute()
+    data = [{"range": f"'{tab}'!A1", "values": [header] + rows} for tab, rows in tabs.items()]
+    values.batchUpdate(spreadsheetId=SPREADSHEET_ID, body={"valueInputOption": "RAW", "data": data}).execute()
+    print(f"Wrote {len(tabs[MATCHES_RANGE_NAME])} matches to the '{MATCHES_RANGE_NAME}' tab", file=sys.stderr)
+
+
+# The request we send to GPT for a prompt (also used for the Batch API file)
+def get_chat_request(prompt):
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": TEMPERATURE,
+        "top_p": TOP_P,
+    }
+
+
+# A function to send input to GPT and get a response. Rate limit errors (HTTP 429) are retried with an exponential
+# backoff, and reported to the rate limiter (if one is given) so that it can slow down the other requests in flight.
+# If a cache is given, a response that was already cached for this prompt is returned without calling GPT.
+# If on_text is given, the response is streamed, and every piece of text is passed to on_text as soon as it arrives.
+# If request_metrics is given, the request's latency, tokens and cost are added to it (a failed request has no tokens
+# and no cost, and is marked with error).
+def get_ai_response(prompt, ai_client=None, rate_limiter=None, cache=None, on_text=None, request_metrics=None):
+    if ai_client is None:
+        ai_client = client
+    if request_metrics is None:
+        request_metrics = {}
+    if cache is not None:
+        cache_key = get_cache_key(prompt)
+        cached_response = cache.get(cache_key)
+        if cached_response is not None:
+            request_metrics.update(latency_seconds=0.0, prompt_tokens=0, completion_tokens=0, tokens_estimated=False,
+                                   cached=True, cost=0.0)
+            if on_text is not None:
+                on_text(cached_response)
+            return cached_response
+    estimated_tokens = estimate_tokens(prompt)
+    for attempt in range(MAX_RETRIES + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire(estimated_tokens)
+        streamed_pieces = []
+        start = time.perf_counter()
+        try:
+            if on_text is None:
+                response = ai_client.chat.completions.create(**get_chat_request(prompt))
+                content = response.choices[0].message.content
+                usage = getattr(response, 'usage', None)
+            else:
+                usage = None
+                for chunk in ai_client.chat.completions.create(stream=True, stream_options={"include_usage": True},
+                                                               **get_chat_request(prompt)):
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        streamed_pieces.append(chunk.choices[0].delta.content)
+                        on_text(chunk.choices[0].delta.content)
+                    # The last chunk has the number of tokens of the whole response
+                    usage = getattr(chunk, 'usage', None) or usage
+                content = "".join(streamed_pieces)
+            if rate_limiter is not None:
+                rate_limiter.release(success=True)
+            record_request_metrics(request_metrics, start, prompt, content, usage, attempt)
+            if cache is not None:
+                cache.put(cache_key, content)
+            return content
+        except Exception as e:
+            if rate_limiter is not None:
+                rate_limiter.release(success=not is_rate_limit_error(e))
+            # A response that already started streaming can't be taken back, so it is not retried
+            if is_rate_limit_error(e) and attempt < MAX_RETRIES and not streamed_pieces:
+                time.sleep(get_retry_delay(e, attempt))
+                continue
+            # A failed request is counted in failed_requests, not in the tokens and the cost
+            request_metrics.update(latency_seconds=time.perf_counter() - start, prompt_tokens=0, completion_tokens=0,
+                                   tokens_estimated=False, cached=False, retries=attempt, cost=0.0, error=True)
+            return f"An error occurred: {str(e)}"
+
+
+# Add the latency, the number of tokens and the cost of a request to request_metrics. The numbers of tokens are taken
+# from the response's usage, and estimated with count_tokens if the response doesn't have them.
+def record_request_metrics(request_metrics, start, prompt, content, usage, retries):
+    if usage is not None:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+    else:
+        prompt_tokens, completion_tokens = count_tokens(prompt), count_tokens(content)
+    request_metrics.update(latency_seconds=time.perf_counter() - start, prompt_tokens=prompt_tokens,
+                           completion_tokens=completion_tokens, tokens_estimated=usage is None, cached=False,
+                           retries=retries, cost=get_cost(prompt_tokens, completion_tokens))
+
+
+# The price of a request in dollars
+def get_cost(prompt_tokens, completion_tokens):
+    return (prompt_tokens * PROMPT_TOKEN_PRICE + completion_tokens * COMPLETION_TOKEN_PRICE) / 1000000
+
+
+# The cache key of a prompt: a hash of everything that affects GPT's response
+def get_cache_key(prompt):
+    key = "\n".join([MODEL, str(TEMPERATURE), str(TOP_P), prompt])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+# An on-disk cache of GPT responses, kept in a SQLite file. Entries older than max_age_days are dropped, and when there
+# are more than max_entries entries, the least recently used ones are dropped. With refresh=True, the cached responses
+# are ignored (but new responses are still saved).
+class ResponseCache:
+    def __init__(self, path=CACHE_FILE, max_entries=CACHE_MAX_ENTRIES, max_age_days=CACHE_MAX_AGE_DAYS,
+                 refresh=False):
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses ("
+                                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                                "created REAL NOT NULL, last_used REAL NOT NULL)")
+        self.connection.commit()
+        self.evict()
+
+    # Returns the cached response, or None if there is none
+    def get(self, key):
+        with self.lock:
+            row = None
+            if not self.refresh:
+                row = self.connection.execute("SELECT response, created FROM responses WHERE key = ?",
+                                              (key,)).fetchone()
+            if row is None or self._is_expired(row[1]):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+            return row[0]
+
+    def put(self, key, response):
+        with self.lock:
+            now = time.time()
+            self.connection.execute("INSERT OR REPLACE INTO responses (key, response, created, last_used) "
+                                    "VALUES (?, ?, ?, ?)", (key, response, now, now))
+            self.connection.commit()
+
+    # Drop the expired entries, and the least recently used entries above max_entries
+    def evict(self):
+        with self.lock:
+            oldest_allowed = time.time() - self.max_age_days * 24 * 60 * 60
+            self.connection.execute("DELETE FROM responses WHERE created < ?", (oldest_allowed,))
+            self.connection.execute("DELETE FROM responses WHERE key NOT IN "
+                                    "(SELECT key FROM responses ORDER BY last_used DESC LIMIT ?)",
+                                    (self.max_entries,))
+            self.connection.commit()
+
+    def _is_expired(self, created):
+        return created < time.time() - self.max_age_days * 24 * 60 * 60
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+
+# Rough number of OpenAI tokens in a prompt (about 4 characters per token)
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+# The exact number of tokens in a text, using the model's tokenizer. tiktoken is optional (pip install tiktoken), and
+# needs to download the tokenizer the first time it is used, so if it is not available we use the rough estimate.
+token_encoding = None
+token_encoding_failed = False
+
+
+def count_tokens(text):
+    global token_encoding, token_encoding_failed
+    if token_encoding is None and not token_encoding_failed:
+        try:
+            import tiktoken
+            token_encoding = tiktoken.encoding_for_model(MODEL)
+        except Exception:
+            token_encoding_failed = True
+    if token_encoding is None:
+        return estimate_tokens(text)
+    return len(token_encoding.encode(text, disallowed_special=()))
+
+
+
+# Returns True if the exception is a 429 "Too Many Requests" error from the API
+def is_rate_limit_error(e):
+    if isinstance(e, openai.RateLimitError):
+        return True
+    return getattr(e, 'status_code', None) == 429
+
+
+# How many seconds to wait before retrying a rate limited request. We use the 'retry-after' header if the API sent
+# one, otherwise an exponential backoff with some random jitter, so that the retries don't all fire at once.
+def get_retry_delay(e, attempt):
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        pass
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+
+# Limits the requests we send to OpenAI so that we stay under the account's requests per minute and tokens per minute
+# limits. It also adapts the number of requests in flight: every 429 error halves it, and every successful request
+# increases it by one, up to max_concurrency.
+class RateLimiter:
+    def __init__(self, max_concurrency, requests_per_minute, tokens_per_minute):
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.in_flight = 0
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_budget = float(requests_per_minute)
+        self.token_budget = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.condition = threading.Condition()
+
+    # Refill the request and token budgets according to the time that passed since the last refill
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_refill) / 60
+        self.last_refill = now
+        self.request_budget = min(self.requests_per_minute,
+                                  self.request_budget + elapsed_minutes * self.requests_per_minute)
+        self.token_budget = min(self.tokens_per_minute,
+                                self.token_budget + elapsed_minutes * self.tokens_per_minute)
+
+    # Block until there is a free slot and enough budget to send a request of the given size
+    def acquire(self, tokens):
+        # A single prompt larger than the whole per minute budget would otherwise wait forever
+        tokens = min(tokens, self.tokens_per_minute)
+        with self.condition:
+            while True:
+                self._refill()
+                if self.in_flight < self.concurrency and self.request_budget >= 1 and self.token_budget >= tokens:
+                    self.in_flight += 1
+                    self.request_budget -= 1
+                    self.token_budget -= tokens
+                    return
+                missing_requests = max(0.0, 1 - self.request_budget) / self.requests_per_minute
+                missing_tokens = max(0.0, tokens - self.token_budget) / self.tokens_per_minute
+                self.condition.wait(timeout=max(missing_requests, missing_tokens) * 60 + 0.01)
+
+    # Free the slot taken by acquire(), and adapt the number of requests in flight
+    def release(self, success):
+        with self.condition:
+            self.in_flight -= 1
+            if success:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            else:
+                self.concurrency = max(1, self.concurrency // 2)
+            self.condition.notify_all()
+
+
+# Send all the prompts to GPT, keeping up to max_concurrency requests in flight. The responses are yielded in the same
+# order as the prompts, each one as soon as it (and all the ones before it) arrived. request_metrics, if given, has a
+# dictionary for every prompt, that the request's metrics are added to.
+def get_ai_responses(prompts, ai_client=None, max_concurrency=None, rate_limiter=None, cache=None,
+                     request_metrics=None):
+    if max_concurrency is None:
+        max_concurrency = MAX_CONCURRENT_REQUESTS
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(max_concurrency, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+    if request_metrics is None:
+        request_metrics = itertools.repeat(None)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [executor.submit(get_ai_response, p, ai_client, rate_limiter, cache, None, metrics)
+                   for p, metrics in zip(prompts, request_metrics)]
+        for future in futures:
+            yield future.result()
+
+
+# Collects the pieces of a streamed response into lines, and puts every complete line in the queue
+class LineQueue:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.text = ""
+        self.partial_line = ""
+
+    def feed(self, text):
+        self.text += text
+        lines = (self.partial_line + text).split('\n')
+        self.partial_line = lines.pop()
+        for line in lines:
+            self.queue.put(line)
+
+    # Put the last line in the queue, followed by None to mark the end of the response. If the request failed, the
+    # error message is put instead of the last line, since a line that was cut off could still look like a valid match.
+    def close(self, error=None):
+        self.queue.put(self.partial_line if error is None else error)
+        self.queue.put(None)
+
+    # The lines of the response, as they arrive
+    def lines(self):
+        return iter(self.queue.get, None)
+
+
+# Send a prompt to GPT, streaming the response into the line queue
+def stream_ai_response(prompt, line_queue, ai_client=None, rate_limiter=None, cache=None, request_metrics=None):
+    error = None
     try:
-        response = client.chat.completions.create(
-            # model="gpt-3.5-turbo",
-            model="gpt-4o",
-            messages=[
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0,  # Set the temperature to 0
-            top_p=1  # Set top_p to 1 for more deterministic output
-        )
-        return response.choices[0].message.content
+        content = get_ai_response(prompt, ai_client, rate_limiter, cache, line_queue.feed, request_metrics)
+        if content != line_queue.text:
+            # An error message
+            error = content
     except Exception as e:
-        return f"An error occurred: {str(e)}"
+        error = f"An error occurred: {str(e)}"
+    finally:
+        line_queue.close(error)
+
+
+# Like get_ai_responses, but the responses are streamed: for every prompt, in the same order as the prompts, yields an
+# iterator over the lines of GPT's response, that returns every line as soon as it arrives
+def stream_ai_responses(prompts, ai_client=None, max_concurrency=None, rate_limiter=None, cache=None,
+                        request_metrics=None):
+    if max_concurrency is None:
+        max_concurrency = MAX_CONCURRENT_REQUESTS
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(max_concurrency, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+    if request_metrics is None:
+        request_metrics = itertools.repeat(None)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        line_queues = []
+        for p, metrics in zip(prompts, request_metrics):
+            line_queue = LineQueue()
+            executor.submit(stream_ai_response, p, line_queue, ai_client, rate_limiter, cache, metrics)
+            line_queues.append(line_queue)
+        for line_queue in line_queues:
+            yield line_queue.lines()
+
+
+# Metrics:
+# For every mentor we keep how long it took to build the prompts, how long GPT took to answer, the number of tokens
+# (as reported by the API) and the estimated cost. They are summarized at the end of the run, and with --metrics
+# metrics.jsonl, also written to a file, one JSON line per mentor and a last line with the summary.
+
+# The metrics of one mentor, and of every request that was sent for it
+class MentorMetrics:
+    def __init__(self, mentor):
+        self.mentor_email = mentor.email
+        self.build_seconds = 0.0
+        self.mentees_per_prompt = []
+        self.requests = []
+
+    # A new dictionary for the metrics of a request, to be filled in by get_ai_response
+    def new_request(self):
+        request_metrics = {}
+        self.requests.append(request_metrics)
+        return request_metrics
+
+    def to_dict(self):
+        latencies = [request.get("latency_seconds", 0.0) for request in self.requests]
+        return {
+            "mentor": self.mentor_email,
+            "prompts": len(self.mentees_per_prompt),
+            "mentees_per_prompt": self.mentees_per_prompt,
+            "prompt_build_seconds": round(self.build_seconds, 6),
+            "requests": len(self.requests),
+            "cached_requests": sum(1 for request in self.requests if request.get("cached")),
+            "failed_requests": sum(1 for request in self.requests if request.get("error")),
+            "request_seconds": round(sum(latencies), 3),
+            "max_request_seconds": round(max(latencies, default=0.0), 3),
+            "prompt_tokens": sum(request.get("prompt_tokens", 0) for request in self.requests),
+            "completion_tokens": sum(request.get("completion_tokens", 0) for request in self.requests),
+            "tokens_estimated": any(request.get("tokens_estimated") for request in self.requests),
+            "cost": round(sum(request.get("cost", 0.0) for request in self.requests), 6),
+        }
+
+
+# Collects the metrics of all the mentors in a run
+class MetricsLog:
+    def __init__(self, path=None):
+        self.start = time.perf_counter()
+        self.mentors = []
+        self.latencies = []
+        self.metrics_file = open(path, 'w', encoding='utf-8') if path else None
+
+    def add(self, mentor_metrics):
+        mentor_dict = mentor_metrics.to_dict()
+        self.mentors.append(mentor_dict)
+        self.latencies.extend(request.get("latency_seconds", 0.0) for request in mentor_metrics.requests
+                              if not request.get("cached"))
+        if self.metrics_file is not None:
+            self.metrics_file.write(json.dumps(mentor_dict) + "\n")
+            self.metrics_file.flush()
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        mentees_per_prompt = [n for mentor in self.mentors for n in mentor["mentees_per_prompt"]]
+        return {
+            "mentors": len(self.mentors),
+            "prompts": len(mentees_per_prompt),
+            "requests": sum(mentor["requests"] for mentor in self.mentors),
+            "cached_requests": sum(mentor["cached_requests"] for mentor in self.mentors),
+            "failed_requests": sum(mentor["failed_requests"] for mentor in self.mentors),
+            "mean_mentees_per_prompt": round(sum(mentees_per_prompt) / len(mentees_per_prompt), 1)
+            if mentees_per_prompt else 0,
+            "prompt_build_seconds": round(sum(mentor["prompt_build_seconds"] for mentor in self.mentors), 3),
+            "median_request_seconds": round(latencies[len(latencies) // 2], 3) if latencies else 0.0,
+            "p95_request_seconds": round(latencies[int(len(latencies) * 0.95)], 3) if latencies else 0.0,
+            "prompt_tokens": sum(mentor["prompt_tokens"] for mentor in self.mentors),
+            "completion_tokens": sum(mentor["completion_tokens"] for mentor in self.mentors),
+            "cost": round(sum(mentor["cost"] for mentor in self.mentors), 4),
+            "wall_seconds": round(time.perf_counter() - self.start, 3),
+        }
+
+    # Print the summary to stderr (and write it to the metrics file)
+    def print_summary(self):
+        summary = self.summary()
+        if self.metrics_file is not None:
+            self.metrics_file.write(json.dumps({"summary": summary}) + "\n")
+            self.metrics_file.close()
+            self.metrics_file = None
+        print(f"{summary['mentors']} mentors, {summary['prompts']} prompts "
+              f"({summary['mean_mentees_per_prompt']} mentees per prompt), {summary['requests']} requests "
+              f"({summary['cached_requests']} cached, {summary['failed_requests']} failed) in "
+              f"{summary['wall_seconds']} seconds", file=sys.stderr)
+        print(f"Building prompts: {summary['prompt_build_seconds']} seconds. Request time: median "
+              f"{summary['median_request_seconds']} seconds, 95th percentile {summary['p95_request_seconds']} "
+              f"seconds", file=sys.stderr)
+        print(f"Tokens: {summary['prompt_tokens']} prompt, {summary['completion_tokens']} completion. "
+              f"Estimated cost: ${summary['cost']}", file=sys.stderr)
+
+
+# Returns the value of a cell, or an empty string if the row is shorter than that (Sheets leaves out empty cells at the
+# end of a row)
+def get_cell(row, col):
+    if col < len(row):
+        return row[col]
+    return ""
+
+
+# The answers we keep for every participant: the attribute name, the spreadsheet column and the label we use for it in
+# the prompt, in the order they appear in the prompt
+PARTICIPANT_FIELDS = [
+    ('first_name', FIRST_NAME_COL, " First name: "),
+    ('last_name', LAST_NAME_COL, " Last name: "),
+    ('email', EMAIL_COL, " email: "),
+    ('city', CITY_COL, " City: "),
+    ('state', STATE_COL, " State: "),
+    ('meeting_location', MEETING_LOCATION_COL, " Meeting location preference: "),
+    ('meeting_preference', MEETING_PREFERENCE_COL, " Meeting type preference: "),
+    ('gender', GENDER_COL, " Gender: "),
+    ('gender_preference', GENDER_PREFERENCE_COL, " Gender preference: "),
+    ('occupation', OCCUPATION_COL, " Occupation: "),
+    ('affiliation', AFFILIATION_COL, " Affiliation: "),
+    ('company', COMPANY_COL, " Company: "),
+    ('industry', INDUSTRY_COL, " Industry: "),
+    ('work_history', WORK_HISTORY_COL, " Work history: "),
+    ('career_path', CAREER_PATH_COL, " Career path: "),
+    ('education', EDUCATION_COL, " Education: "),
+    ('higher_education', HIGHER_EDUCATION_COL, " Higher education: "),
+    ('degree', DEGREE_COL, " Degree: "),
+    ('values', VALUES_COL, " Values: "),
+    ('about_me', ABOUT_ME_COL, " About me: "),
+    ('hobbies', HOBBIES_COL, " Hobbies: "),
+    ('focus_area', FOCUS_AREA_COL, " Focus area: "),
+    ('expectations_and_hopes', ANSWER_Q1_EXPECTATIONS_AND_HOPES_COL, " Expectations and hopes: "),
+    ('anything_else', ANSWER_Q2_ANYTHING_ELSE_COL, " Would you like to add anything else? "),
+]
+# Columns with a few possible answers, that many participants share. We keep only one copy of each of these strings.
+CATEGORICAL_COLS = {ROLE_COL, CITY_COL, STATE_COL, MEETING_LOCATION_COL, MEETING_PREFERENCE_COL, GENDER_COL,
+                    GENDER_PREFERENCE_COL, AFFILIATION_COL, INDUSTRY_COL, EDUCATION_COL, HIGHER_EDUCATION_COL}
+COLUMN_ATTRIBUTES = {col: name for name, col, label in PARTICIPANT_FIELDS}
+
+
+# A mentor or mentee, read from one row of the spreadsheet. The participant's record for the prompt is built once, here,
+# and then reused in every prompt the participant is part of.
+class Participant:
+    __slots__ = ['row', 'role', 'gender_key', 'record', 'record_tokens'] + \
+                [name for name, col, label in PARTICIPANT_FIELDS]
+
+    def __init__(self, row, cells):
+        self.row = row
+        self.role = sys.intern(str(get_cell(cells, ROLE_COL)))
+        for name, col, label in PARTICIPANT_FIELDS:
+            value = str(get_cell(cells, col))
+            if col in CATEGORICAL_COLS:
+                value = sys.intern(value)
+            setattr(self, name, value)
+        self.gender_key = (normalize_gender(self.gender), normalize_gender(self.gender_preference))
+        self.record = "".join([label + getattr(self, name) + "\n" for name, col, label in PARTICIPANT_FIELDS])
+        self.record_tokens = count_tokens(self.record)
+
+    # The answer in the given spreadsheet column
+    def get(self, col):
+        return getattr(self, COLUMN_ATTRIBUTES[col])
+
+    def is_mentor(self):
+        return "Mentor" in self.role
+
+    def is_mentee(self):
+        return "Mentee" in self.role
+
+
+# Read all the participants from the spreadsheet (the first row is the header)
+def read_participants(response_spreadsheet):
+    return [Participant(j, response_spreadsheet[j]) for j in range(1, len(response_spreadsheet))]
+
+
+# Gender preference answers are typed in slightly differently by different people (for example "No preference" and
+# "No Preference "), so we compare them after removing extra spaces and upper case letters
+NO_PREFERENCE = "no preference"
+
+
+def normalize_gender(value):
+    value = " ".join(str(value).split()).lower()
+    if NO_PREFERENCE in value:
+        return NO_PREFERENCE
+    return value
+
 
 # A function for filtering out mentees who do not match by gender preferences of either mentor or mentee
 def is_gender_match(gender_mentor, gender_pref_mentor, gender_mentee, gender_pref_mentee):
-    # Both are No preference
-    if "No preference" in str(gender_pref_mentor) and "No preference" in str(gender_pref_mentee):
-        return True
+    gender_mentor = normalize_gender(gender_mentor)
+    gender_pref_mentor = normalize_gender(gender_pref_mentor)
+    gender_mentee = normalize_gender(gender_mentee)
+    gender_pref_mentee = normalize_gender(gender_pref_mentee)
 
-    # None are No preference
-    if str(gender_mentor) == str(gender_pref_mentee) and str(gender_mentee) == str(gender_pref_mentor):
-        return True
+    # The mentee is what the mentor prefers (or the mentor has no preference), and the other way around
+    mentor_accepts = gender_pref_mentor == NO_PREFERENCE or gender_mentee == gender_pref_mentor
+    mentee_accepts = gender_pref_mentee == NO_PREFERENCE or gender_mentor == gender_pref_mentee
+    return mentor_accepts and mentee_accepts
 
-    # Mentor is No preference and Mentee has preference
-    if "No preference" in str(gender_pref_mentor) and str(gender_mentor) == str(gender_pref_mentee):
-        return True
 
-    # Mentee is No preference and Mentor has preference
-    if "No preference" in str(gender_pref_mentee) and str(gender_mentee) == str(gender_pref_mentor):
-        return True
+# An index of the mentees by their (gender, gender preference), built once per run. Instead of checking every mentor
+# against every mentee, we check every mentor's (gender, gender preference) against the few different (gender, gender
+# preference) buckets, and take the mentees in the compatible buckets.
+class GenderIndex:
+    def __init__(self, participants):
+        self.mentors = [participant for participant in participants if participant.is_mentor()]
+        self.mentees = [participant for participant in participants if participant.is_mentee()]
+        self.buckets = {}
+        for mentee in self.mentees:
+            self.buckets.setdefault(mentee.gender_key, []).append(mentee)
+        self._compatible_mentees = {}
+
+    # All the mentees that match the mentor, in spreadsheet order
+    def compatible_mentees(self, mentor):
+        if mentor.gender_key not in self._compatible_mentees:
+            mentees = []
+            for mentee_key, bucket in self.buckets.items():
+                if is_gender_match(*mentor.gender_key, *mentee_key):
+                    mentees += bucket
+            self._compatible_mentees[mentor.gender_key] = sorted(mentees, key=lambda mentee: mentee.row)
+        return self._compatible_mentees[mentor.gender_key]
+
+    # A boolean matrix with a row for every mentor and a column for every mentee (in the order of the given lists),
+    # that is True where they match. Other filters can be combined with it using &.
+    def compatibility_matrix(self, mentors=None, mentees=None):
+        if mentors is None:
+            mentors = self.mentors
+        if mentees is None:
+            mentees = self.mentees
+        all_keys = list(dict.fromkeys([mentor.gender_key for mentor in mentors] +
+                                      [mentee.gender_key for mentee in mentees]))
+        key_ids = {key: k for k, key in enumerate(all_keys)}
+        key_matrix = np.array([[is_gender_match(*mentor_key, *mentee_key) for mentee_key in all_keys]
+                               for mentor_key in all_keys], dtype=bool).reshape(len(all_keys), len(all_keys))
+        mentor_ids = np.array([key_ids[mentor.gender_key] for mentor in mentors], dtype=np.intp)
+        mentee_ids = np.array([key_ids[mentee.gender_key] for mentee in mentees], dtype=np.intp)
+        return key_matrix[np.ix_(mentor_ids, mentee_ids)]
+
+
+# Locations:
+EARTH_RADIUS_MILES = 3958.8
+STATE_ABBREVIATIONS = {
+    "alabama": "AL", "alaska": "AK", "arizona": "AZ", "arkansas": "AR", "california": "CA", "colorado": "CO",
+    "connecticut": "CT", "delaware": "DE", "district of columbia": "DC", "florida": "FL", "georgia": "GA",
+    "hawaii": "HI", "idaho": "ID", "illinois": "IL", "indiana": "IN", "iowa": "IA", "kansas": "KS", "kentucky": "KY",
+    "louisiana": "LA", "maine": "ME", "maryland": "MD", "massachusetts": "MA", "michigan": "MI", "minnesota": "MN",
+    "mississippi": "MS", "missouri": "MO", "montana": "MT", "nebraska": "NE", "nevada": "NV", "new hampshire": "NH",
+    "new jersey": "NJ", "new mexico": "NM", "new york": "NY", "north carolina": "NC", "north dakota": "ND",
+    "ohio": "OH", "oklahoma": "OK", "oregon": "OR", "pennsylvania": "PA", "rhode island": "RI",
+    "south carolina": "SC", "south dakota": "SD", "tennessee": "TN", "texas": "TX", "utah": "UT", "vermont": "VT",
+    "virginia": "VA", "washington": "WA", "west virginia": "WV", "wisconsin": "WI", "wyoming": "WY",
+}
+
+# Gazetteers read from their files, by path
+gazetteers = {}
 
-    return False
 
-# Sometimes GPT adds empty lines to the output. This functions gets rid of them, so we can move the output into a csv easily.
-def remove_empty_lines(input_string):
-    # Split the input string into lines
-    lines = input_string.split('\n')
+# Lower case, without punctuation and extra spaces, so that "St. Louis" and "st louis" are the same
+def normalize_place(text):
+    return " ".join(re.sub(r"[^\w\s-]", " ", text.lower()).split())
 
-    # Filter out empty lines
-    non_empty_lines = [line for line in lines if line.strip()]
 
-    # Join the non-empty lines back into a string
-    result = '\n'.join(non_empty_lines)
+def normalize_state(state):
+    state = normalize_place(state)
+    return STATE_ABBREVIATIONS.get(state, state.upper())
+
+
+# Read the gazetteer: (city, state) -> (latitude, longitude, metropolitan area). A city that is only in one state can
+# also be found without the state.
+def load_gazetteer(path=None):
+    if path is None:
+        path = GAZETTEER_FILE
+    if path not in gazetteers:
+        gazetteer = {}
+        states_by_city = {}
+        with open(path, newline='', encoding='utf-8') as gazetteer_file:
+            for row in csv.DictReader(gazetteer_file):
+                city = normalize_place(row['city'])
+                gazetteer[(city, row['state'])] = (float(row['latitude']), float(row['longitude']), row['metro'])
+                states_by_city.setdefault(city, []).append(row['state'])
+        for city, states in states_by_city.items():
+            if len(states) == 1:
+                gazetteer[(city, "")] = gazetteer[(city, states[0])]
+        gazetteers[path] = gazetteer
+    return gazetteers[path]
+
+
+# The (latitude, longitude, metropolitan area) of the participant's city, or None if it is not in the gazetteer.
+# Accepts cities written with the state, such as "Palo Alto, CA", and "New York City".
+def get_location(participant, gazetteer):
+    city, state = participant.city, participant.state
+    if ',' in city:
+        city, city_state = city.split(',', 1)
+        state = state or city_state
+    city = normalize_place(city)
+    state = normalize_state(state) if state.strip() else ""
+    location = gazetteer.get((city, state))
+    if location is None and city.endswith(" city"):
+        location = gazetteer.get((city[:-len(" city")], state))
+    return location
+
+
+# Whether the participant only wants to meet in person, by their meeting type answer (the meeting location answer is
+# free text, and "In person preferred" still allows meeting remotely)
+def is_in_person_only(participant):
+    meeting_preference = participant.meeting_preference.lower()
+    if not re.search(r"\bonly\b", meeting_preference):
+        return False
+    if any(re.search(r"\b" + word + r"\b", meeting_preference) for word in REMOTE_MEETING_WORDS):
+        return False
+    return any(word in meeting_preference for word in IN_PERSON_WORDS)
+
+
+# The great circle distance in miles between points given in degrees, for numpy arrays of any (broadcastable) shape
+def haversine_miles(latitudes1, longitudes1, latitudes2, longitudes2):
+    latitudes1, longitudes1, latitudes2, longitudes2 = map(np.radians, (latitudes1, longitudes1, latitudes2,
+                                                                         longitudes2))
+    a = np.sin((latitudes2 - latitudes1) / 2) ** 2 + \
+        np.cos(latitudes1) * np.cos(latitudes2) * np.sin((longitudes2 - longitudes1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+# A boolean matrix that is True for every two locations at most max_miles apart, with all the distances computed at once
+def near_locations(latitudes, longitudes, max_miles):
+    return haversine_miles(latitudes[:, None], longitudes[:, None], latitudes[None, :], longitudes[None, :]) <= max_miles
+
+
+# A boolean matrix with a row for every mentor and a column for every mentee, that is False where the pair is
+# disqualified by location: they live more than max_miles apart, not in the same metropolitan area, and at least one of
+# them only wants to meet in person. Can be combined with the gender compatibility matrix using &.
+def location_matrix(mentors, mentees, max_miles=None, gazetteer=None):
+    if max_miles is None:
+        max_miles = MAX_DISTANCE_MILES
+    if gazetteer is None:
+        gazetteer = load_gazetteer()
+    participants = mentors + mentees
+    # Every distinct city once
+    location_ids = {}
+    participant_locations = np.full(len(participants), -1, dtype=np.intp)
+    for k, participant in enumerate(participants):
+        location = get_location(participant, gazetteer)
+        if location is not None:
+            participant_locations[k] = location_ids.setdefault(location, len(location_ids))
+    in_person_only = np.array([is_in_person_only(participant) for participant in participants], dtype=bool)
+    if not location_ids:
+        return np.ones((len(mentors), len(mentees)), dtype=bool)
+    locations = list(location_ids)
+    latitudes = np.array([location[0] for location in locations], dtype=float)
+    longitudes = np.array([location[1] for location in locations], dtype=float)
+    metro_ids = {}
+    location_metros = np.array([metro_ids.setdefault(location[2], len(metro_ids)) if location[2] else -1
+                                for location in locations], dtype=np.intp)
+    near = near_locations(latitudes, longitudes, max_miles)
+
+    known = participant_locations >= 0
+    # Participants without a location get the first location here, and are left out by known below
+    participant_locations = np.maximum(participant_locations, 0)
+    participant_metros = np.where(known, location_metros[participant_locations], -1)
+    mentor_locations, mentee_locations = participant_locations[:len(mentors)], participant_locations[len(mentors):]
+    mentor_metros, mentee_metros = participant_metros[:len(mentors)], participant_metros[len(mentors):]
+    close = near[np.ix_(mentor_locations, mentee_locations)]
+    close |= (mentor_metros[:, None] == mentee_metros[None, :]) & (mentor_metros[:, None] >= 0)
+    disqualified = (in_person_only[:len(mentors), None] | in_person_only[None, len(mentors):]) & \
+        known[:len(mentors), None] & known[None, len(mentors):] & ~close
+    return ~disqualified
+
+
+# A boolean matrix with a row for every mentor and a column for every mentee of the gender index, that is True where
+# they can be matched: gender compatible, and, with LOCATION_FILTER, not disqualified by location
+def get_allowed_pairs(gender_index):
+    allowed = gender_index.compatibility_matrix()
+    if LOCATION_FILTER:
+        allowed &= location_matrix(gender_index.mentors, gender_index.mentees)
+    return allowed
+
+
+# Prints how many gender compatible pairs the location filter disqualified, and how much smaller that made the mentee
+# lists that are actually sent (the shortlists, if there are shortlists), by comparing them to the lists without it
+def print_location_pruning(gender_index, compatible, allowed, unfiltered_pools, pools):
+    mentee_ids = {id(mentee): n for n, mentee in enumerate(gender_index.mentees)}
+    replaced = sum(1 for m, mentor in enumerate(gender_index.mentors) for mentee in unfiltered_pools[mentor]
+                   if not allowed[m, mentee_ids[id(mentee)]])
+    unfiltered_mentees = sum(len(mentees) for mentees in unfiltered_pools.values())
+    filtered_mentees = sum(len(mentees) for mentees in pools.values())
+    unfiltered_tokens = sum(mentee.record_tokens for mentees in unfiltered_pools.values() for mentee in mentees)
+    filtered_tokens = sum(mentee.record_tokens for mentees in pools.values() for mentee in mentees)
+    print(f"Location filter: {int((compatible & ~allowed).sum())} of {int(compatible.sum())} gender compatible "
+          f"pairs are disqualified. {replaced} disqualified mentees were kept out of the mentee lists sent to GPT, "
+          f"which have {filtered_mentees} mentees instead of {unfiltered_mentees}, and "
+          f"{unfiltered_tokens - filtered_tokens} fewer tokens of mentee records", file=sys.stderr)
 
-    return result
 
 # This is the initial prompt, we will then add the mentor and mentees to this prompt, and sent to GPT to get the matches
 prompt = "Below are two sections. The first section contains details about a mentor. The second section contains a list " \
@@ -232,143 +1134,780 @@ prompt += "When giving the scores for the mentorship compatibility, please only
           "A record should always start with the name of the mentor. " \
           "Please sort the mentees according to score, from high to lower"
 
+MENTOR_RECORD_HEADER = "Here is the Mentor record: \n"
+MENTEE_RECORDS_HEADER = "And here is the list of Mentee records: \n"
+
+
+# Build the mentor record, followed by the records of the given mentees
+def build_mentor_record(mentor, mentees):
+    current_record = MENTOR_RECORD_HEADER + mentor.record + MENTEE_RECORDS_HEADER + \
+                     "".join([mentee.record for mentee in mentees])
+
+    return current_record
+
+# Split a text into lower case words, without the stop words
+def tokenize(text):
+    return [word for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in STOP_WORDS and len(word) > 1]
+
+
+# Build the TF-IDF vectors of the given participants, as the rows of a sparse matrix with unit length rows. Words that
+# appear in only one participant's answers can't make two participants similar, so they are left out.
+def tfidf_matrix(participants, cols=None):
+    if cols is None:
+        cols = SHORTLIST_COLS
+    documents = [tokenize(" ".join(participant.get(col) for col in cols)) for participant in participants]
+    document_frequency = {}
+    for words in documents:
+        for word in set(words):
+            document_frequency[word] = document_frequency.get(word, 0) + 1
+    vocabulary = {word: k for k, word in enumerate(w for w, df in document_frequency.items() if df > 1)}
+
+    rows, cols = [], []
+    for d, words in enumerate(documents):
+        for word in words:
+            k = vocabulary.get(word)
+            if k is not None:
+                rows.append(d)
+                cols.append(k)
+    # Repeated (row, column) entries are summed, so this counts every word of every participant
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                               shape=(len(documents), len(vocabulary)))
+    matrix.sum_duplicates()
+    idf = np.zeros(len(vocabulary), dtype=np.float32)
+    for word, k in vocabulary.items():
+        idf[k] = np.log((1 + len(documents)) / (1 + document_frequency[word])) + 1
+    matrix.data = np.log1p(matrix.data) * idf[matrix.indices]
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms).dot(matrix).tocsr()
+
+
+# The TF-IDF similarity of every mentor (rows) to every mentee (columns) of the gender index. The result is dense, so
+# it is computed from the sparse mentor vectors and the mentee vectors of block_size mentees at a time made dense,
+# which is much faster than a sparse by sparse product and keeps the dense part small.
+def similarity_matrix(gender_index, block_size=1024):
+    mentors, mentees = gender_index.mentors, gender_index.mentees
+    matrix = tfidf_matrix(mentors + mentees)
+    mentor_matrix, mentee_matrix = matrix[:len(mentors)], matrix[len(mentors):]
+    similarity = np.empty((len(mentors), len(mentees)), dtype=np.float32)
+    for start in range(0, len(mentees), block_size):
+        similarity[:, start:start + block_size] = mentor_matrix @ mentee_matrix[start:start + block_size].T.toarray()
+    return similarity
+
+
+# Returns a dictionary from each mentor to the list of the shortlist_size gender compatible mentees that are most
+# similar to the mentor, in spreadsheet order. Only the pairs in allowed (by default, get_allowed_pairs) can be
+# shortlisted. The similarity matrix is computed if not given.
+def shortlist_mentees(gender_index, shortlist_size=None, allowed=None, similarity=None):
+    if shortlist_size is None:
+        shortlist_size = SHORTLIST_SIZE
+    if allowed is None:
+        allowed = get_allowed_pairs(gender_index)
+    if similarity is None:
+        similarity = similarity_matrix(gender_index)
+    mentors, mentees = gender_index.mentors, gender_index.mentees
+    similarity = np.where(allowed, similarity, np.float32(-np.inf))
+
+    shortlists = {}
+    for m, mentor in enumerate(mentors):
+        compatible = np.flatnonzero(similarity[m] > -np.inf)
+        if len(compatible) > shortlist_size:
+            top = np.argpartition(-similarity[m, compatible], shortlist_size - 1)[:shortlist_size]
+            compatible = np.sort(compatible[top])
+        shortlists[mentor] = [mentees[n] for n in compatible]
+    return shortlists
+
+
+# Prints which part of the matches GPT found with all the mentees would have been in the shortlist of each size
+def print_shortlist_recall(gender_index, full_pool_matches, shortlist_sizes):
+    matched_emails_by_mentor = {}
+    for records in full_pool_matches:
+        for record in records:
+            matched_emails_by_mentor.setdefault(normalize_email(record.mentor_email), []).append(
+                normalize_email(record.mentee_email))
+    for shortlist_size in shortlist_sizes:
+        shortlists = shortlist_mentees(gender_index, shortlist_size)
+        found = total = 0
+        for mentor, shortlist in shortlists.items():
+            shortlist_emails = {normalize_email(mentee.email) for mentee in shortlist}
+            matched_emails = matched_emails_by_mentor.get(normalize_email(mentor.email), [])
+            found += sum(1 for email in matched_emails if email in shortlist_emails)
+            total += len(matched_emails)
+        recall = found / total if total else 1.0
+        print(f"Shortlist of {shortlist_size} mentees: recall {recall:.1%} ({found} of {total} matches)",
+              file=sys.stderr)
+
+
+# The mentees of the allowed pairs to send to GPT with each mentor: the shortlist, or all of them
+def select_mentor_pools(gender_index, allowed, shortlist_size, similarity=None):
+    if shortlist_size:
+        return shortlist_mentees(gender_index, shortlist_size, allowed, similarity)
+    return {mentor: [gender_index.mentees[n] for n in np.flatnonzero(allowed[m])]
+            for m, mentor in enumerate(gender_index.mentors)}
+
+
+# Returns the mentees to send to GPT with each mentor: the shortlist, or all the gender compatible mentees (that are
+# not disqualified by location, with LOCATION_FILTER)
+def get_mentor_pools(gender_index, shortlist_size=None):
+    if shortlist_size is None:
+        shortlist_size = SHORTLIST_SIZE
+    if not LOCATION_FILTER:
+        if not shortlist_size:
+            return {mentor: gender_index.compatible_mentees(mentor) for mentor in gender_index.mentors}
+        return shortlist_mentees(gender_index, shortlist_size)
+    compatible = gender_index.compatibility_matrix()
+    allowed = compatible & location_matrix(gender_index.mentors, gender_index.mentees)
+    similarity = similarity_matrix(gender_index) if shortlist_size else None
+    pools = select_mentor_pools(gender_index, allowed, shortlist_size, similarity)
+    unfiltered_pools = select_mentor_pools(gender_index, compatible, shortlist_size, similarity)
+    print_location_pruning(gender_index, compatible, allowed, unfiltered_pools, pools)
+    return pools
+
+
+# One line of GPT's output: a match between the mentor and a mentee, with the scores
+class MatchRecord:
+    __slots__ = ['mentor_name', 'mentor_email', 'mentee_name', 'mentee_email', 'overall_score', 'occupation_score',
+                 'education_score', 'values_score', 'anything_else_score', 'rationale']
+
+    def __init__(self, mentor_name, mentor_email, mentee_name, mentee_email, overall_score, occupation_score,
+                 education_score, values_score, anything_else_score, rationale):
+        self.mentor_name = mentor_name
+        self.mentor_email = mentor_email
+        self.mentee_name = mentee_name
+        self.mentee_email = mentee_email
+        self.overall_score = overall_score
+        self.occupation_score = occupation_score
+        self.education_score = education_score
+        self.values_score = values_score
+        self.anything_else_score = anything_else_score
+        self.rationale = rationale
+
+    # The record split into spreadsheet columns
+    def to_row(self):
+        return [self.mentor_name, self.mentor_email, self.mentee_name, self.mentee_email, self.overall_score,
+                self.occupation_score, self.education_score, self.values_score, self.anything_else_score,
+                self.rationale]
+
+    # The line in the format we asked GPT for, to be split into columns in a spreadsheet
+    def to_line(self):
+        return f"{self.mentor_name}; {self.mentor_email}; {self.mentee_name}; {self.mentee_email}; " \
+               f"{self.overall_score} / 40; Occupation {self.occupation_score} /10; " \
+               f"Education {self.education_score} / 10; Values {self.values_score} / 10; " \
+               f"Anything else {self.anything_else_score} / 10; {self.rationale}"
+
+
+# The score fields of a line: the label before the score, and the highest possible score
+SCORE_FIELDS = [("", 40), ("occupation", 10), ("education", 10), ("values", 10), ("anything else", 10)]
+
+
+def normalize_email(email):
+    return email.strip().lower()
+
+
+# Read a line of GPT's output into a MatchRecord. If the line is not in the format we asked for, or the emails are not
+# the mentor's and one of the mentees' in the prompt (when they are given), raises a ValueError that explains why.
+def parse_match_line(line, mentor_email=None, mentee_emails=None):
+    if line.startswith("An error occurred"):
+        raise ValueError(line)
+    fields = [field.strip() for field in line.split(';')]
+    if len(fields) < 10:
+        raise ValueError(f"expected 10 fields separated by ';', found {len(fields)}")
+    scores = []
+    for (label, maximum), field in zip(SCORE_FIELDS, fields[4:9]):
+        score = re.fullmatch(re.escape(label) + r"\s*(\d+)\s*/\s*" + str(maximum), field, re.IGNORECASE)
+        if score is None or int(score.group(1)) > maximum:
+            raise ValueError(f"expected '{label + ' ' if label else ''}[score] / {maximum}', found '{field}'")
+        scores.append(int(score.group(1)))
+    if mentor_email is not None and normalize_email(fields[1]) != normalize_email(mentor_email):
+        raise ValueError(f"expected the mentor email {mentor_email}, found '{fields[1]}'")
+    if mentee_emails is not None and normalize_email(fields[3]) not in mentee_emails:
+        raise ValueError(f"'{fields[3]}' is not the email of any of the mentees")
+    # The rationale may have semicolons of its own
+    return MatchRecord(fields[0], fields[1], fields[2], fields[3], *scores, "; ".join(fields[9:]))
+
+
+# Asks GPT to fix the lines it got wrong
+FORMAT_RETRY_NOTE = "\nSome of the lines in your previous answer were not in the format above, or had an email that " \
+                    "is not in the records above. These are the wrong lines:\n{wrong_lines}\n" \
+                    "Please answer again, using only the exact format above."
+
+
+# Parse GPT's output for the mentor and the given mentees, and yield the valid matches (at most MATCHES_PER_MENTOR,
+# every mentee once) as soon as their line arrives. Invalid lines are reported, and if there were any, the mentor is
+# sent to GPT again, up to MAX_FORMAT_RETRIES times, to fill in the missing matches. The lines that were still wrong
+# after the retries are added to wrong_lines_left (if given). The retries go through rate_limiter (if given), with the
+# other requests of the run.
+def check_matches(mentor, mentees, lines, ai_client=None, cache=None, wrong_lines_left=None, mentor_metrics=None,
+                  rate_limiter=None):
+    mentee_emails = {normalize_email(mentee.email) for mentee in mentees}
+    matched_emails = set()
+    mentor_prompt = prompt + build_mentor_record(mentor, mentees)
+    for attempt in range(MAX_FORMAT_RETRIES + 1):
+        wrong_lines = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                record = parse_match_line(line.strip(), mentor.email, mentee_emails)
+            except ValueError as e:
+                print(f"Invalid line for mentor {mentor.email}: {e}", file=sys.stderr)
+                wrong_lines.append(line.strip())
+                continue
+            if normalize_email(record.mentee_email) in matched_emails or \
+                    len(matched_emails) >= MATCHES_PER_MENTOR:
+                continue
+            matched_emails.add(normalize_email(record.mentee_email))
+            yield record
+        if not wrong_lines or attempt == MAX_FORMAT_RETRIES:
+            if wrong_lines_left is not None:
+                wrong_lines_left += wrong_lines
+            return
+        if all(line.startswith("An error occurred") for line in wrong_lines):
+            retry_prompt = mentor_prompt
+        else:
+            retry_prompt = mentor_prompt + FORMAT_RETRY_NOTE.format(wrong_lines="\n".join(wrong_lines))
+        request_metrics = mentor_metrics.new_request() if mentor_metrics is not None else None
+        lines = get_ai_response(retry_prompt, ai_client, rate_limiter, cache,
+                                request_metrics=request_metrics).split('\n')
+
+
+# The most tokens a prompt can have: PROMPT_TOKEN_BUDGET, and no more than a single request can use out of
+# TOKENS_PER_MINUTE
+def get_prompt_token_budget():
+    return min(PROMPT_TOKEN_BUDGET, TOKENS_PER_MINUTE - COMPLETION_TOKEN_ROOM)
+
+
+# Split the mentees into chunks, so that the prompt for the mentor and each chunk has at most token_budget tokens.
+# Returns a single chunk with all the mentees if they fit.
+def plan_mentee_chunks(mentor, mentees, token_budget=None):
+    if token_budget is None:
+        token_budget = get_prompt_token_budget()
+    fixed_tokens = count_tokens(prompt + MENTOR_RECORD_HEADER + mentor.record + MENTEE_RECORDS_HEADER)
+    chunks = [[]]
+    chunk_tokens = fixed_tokens
+    for mentee in mentees:
+        if chunks[-1] and chunk_tokens + mentee.record_tokens > token_budget:
+            chunks.append([])
+            chunk_tokens = fixed_tokens
+        chunks[-1].append(mentee)
+        chunk_tokens += mentee.record_tokens
+    return chunks
+
+
+# Merge the matches of all the chunks of one mentor: every mentee once (with its highest score), sorted from the highest
+# overall score to the lowest. Ties are broken by the other scores and then by the mentee email, so that the same
+# matches always come out in the same order, whether they came from GPT or from the score store.
+def collect_chunk_matches(chunk_records):
+    best = {}
+    for records in chunk_records:
+        for record in records:
+            mentee_email = normalize_email(record.mentee_email)
+            if mentee_email not in best or record.overall_score > best[mentee_email].overall_score:
+                best[mentee_email] = record
+    return sorted(best.values(), key=lambda record: (-record.overall_score, -record.occupation_score,
+                                                     -record.education_score, -record.values_score,
+                                                     -record.anything_else_score,
+                                                     normalize_email(record.mentee_email)))
+
+
+# The best matches_per_mentor matches of all the chunks of one mentor
+def merge_top_matches(chunk_records, matches_per_mentor=None):
+    if matches_per_mentor is None:
+        matches_per_mentor = MATCHES_PER_MENTOR
+    return collect_chunk_matches(chunk_records)[:matches_per_mentor]
+
+
+# Ask GPT to pick the final matches for the mentor, out of the best mentees of all the chunks (as many as fit in the
+# token budget)
+def rerank_chunk_matches(mentor, mentees, chunk_records, ai_client=None, cache=None, mentor_metrics=None,
+                         rate_limiter=None):
+    mentees_by_email = {normalize_email(mentee.email): mentee for mentee in mentees}
+    candidates = [mentees_by_email[normalize_email(record.mentee_email)]
+                  for record in collect_chunk_matches(chunk_records)
+                  if normalize_email(record.mentee_email) in mentees_by_email]
+    candidates = plan_mentee_chunks(mentor, candidates)[0]
+    request_metrics = mentor_metrics.new_request() if mentor_metrics is not None else None
+    openai_matching = get_ai_response(prompt + build_mentor_record(mentor, candidates), ai_client, rate_limiter, cache,
+                                      request_metrics=request_metrics)
+    return list(check_matches(mentor, candidates, openai_matching.split('\n'), ai_client, cache,
+                              mentor_metrics=mentor_metrics, rate_limiter=rate_limiter))
+
+
+# Tells GPT that the prompt has several mentors, with the mentees first
+PACKED_PROMPT_NOTE = "\nThis time the mentee records come first, and then several mentor records. Find the top 10 " \
+                     "mentees for every one of the mentors separately, using the format above, and write all the " \
+                     "lines of one mentor before moving on to the next mentor.\n"
+PACKED_MENTEE_RECORDS_HEADER = "Here is the list of Mentee records: \n"
+PACKED_MENTOR_RECORDS_HEADER = "And here are the Mentor records: \n"
+
+
+# The mentees and the mentors for a packed prompt. The instructions and the mentee list go first, so that the prompts of
+# all the packs with the same mentees start the same way, and the provider's prompt caching can reuse that part.
+def build_packed_record(mentors, mentees):
+    return PACKED_PROMPT_NOTE + PACKED_MENTEE_RECORDS_HEADER + "".join([mentee.record for mentee in mentees]) + \
+           PACKED_MENTOR_RECORDS_HEADER + "".join([mentor.record for mentor in mentors])
+
+
+# Group the mentors that are sent with exactly the same mentees in a single prompt (such as mentors in the same gender
+# bucket, when there is no shortlist) into packs of up to mentors_per_prompt mentors, as long as the packed prompt fits
+# in token_budget. Returns the pack of every packed mentor, in the order of the mentors. Mentors with no mentees or
+# more than one chunk of them, or without another mentor to share a prompt with, are not packed.
+def plan_mentor_packs(mentors, mentor_chunks, token_budget=None, mentors_per_prompt=None):
+    if token_budget is None:
+        token_budget = get_prompt_token_budget()
+    if mentors_per_prompt is None:
+        mentors_per_prompt = MENTORS_PER_PROMPT
+    fixed_tokens = count_tokens(prompt + PACKED_PROMPT_NOTE + PACKED_MENTEE_RECORDS_HEADER +
+                                PACKED_MENTOR_RECORDS_HEADER)
+    open_packs = {}
+    mentor_packs = {}
+    for mentor, chunks in zip(mentors, mentor_chunks):
+        if len(chunks) != 1 or not chunks[0]:
+            continue
+        key = tuple(mentee.row for mentee in chunks[0])
+        pack, pack_tokens = open_packs.get(key, (None, 0))
+        if pack is None or len(pack) >= mentors_per_prompt or pack_tokens + mentor.record_tokens > token_budget:
+            pack = []
+            pack_tokens = fixed_tokens + sum(mentee.record_tokens for mentee in chunks[0])
+        pack.append(mentor)
+        open_packs[key] = (pack, pack_tokens + mentor.record_tokens)
+        mentor_packs[mentor] = pack
+    return {mentor: pack for mentor, pack in mentor_packs.items() if len(pack) > 1}
+
+
+# Split GPT's answer for a pack into the lines of every mentor in it, by the mentor email in each line. A mentor with
+# no lines has no mentee worth listing. If the request failed (even after some lines were streamed), every mentor of
+# the pack is sent to GPT again on its own.
+def split_packed_matches(pack, mentees, lines, ai_client=None, cache=None, mentor_metrics=None, rate_limiter=None):
+    mentor_lines = {normalize_email(mentor.email): [] for mentor in pack}
+    for line in lines:
+        fields = line.split(';')
+        if len(fields) > 1 and normalize_email(fields[1]) in mentor_lines:
+            mentor_lines[normalize_email(fields[1])].append(line)
+        elif line.strip() and not line.startswith("An error occurred"):
+            print(f"Line without a mentor of the pack: {line.strip()}", file=sys.stderr)
+    failed = any(line.startswith("An error occurred") for line in lines)
+    pack_lines = {}
+    for mentor in pack:
+        lines = mentor_lines[normalize_email(mentor.email)]
+        if failed:
+            request_metrics = mentor_metrics.new_request() if mentor_metrics is not None else None
+            lines = get_ai_response(prompt + build_mentor_record(mentor, mentees), ai_client, rate_limiter, cache,
+                                    request_metrics=request_metrics).split('\n')
+        pack_lines[mentor] = lines
+    return pack_lines
+
+
+# Prints how much the matches of the packed prompts agree with the matches of a prompt per mentor: how many of the
+# mentees were picked in both modes, and how far apart their overall scores are
+def print_packing_agreement(single_matches, packed_matches):
+    packed_by_mentor = {}
+    for records in packed_matches:
+        for record in records:
+            packed_by_mentor.setdefault(normalize_email(record.mentor_email), {})[
+                normalize_email(record.mentee_email)] = record.overall_score
+    same = total = 0
+    score_differences = []
+    for records in single_matches:
+        for record in records:
+            packed_scores = packed_by_mentor.get(normalize_email(record.mentor_email), {})
+            total += 1
+            if normalize_email(record.mentee_email) in packed_scores:
+                same += 1
+                score_differences.append(abs(packed_scores[normalize_email(record.mentee_email)] -
+                                             record.overall_score))
+    agreement = same / total if total else 1.0
+    mean_difference = sum(score_differences) / len(score_differences) if score_differences else 0.0
+    print(f"Packed prompts: {agreement:.1%} of the matches agree ({same} of {total}), overall scores differ by "
+          f"{mean_difference:.1f} on average", file=sys.stderr)
+
+
+# Send every mentor to GPT, and yield the matches for each mentor in the same order as the mentors. Mentors with too
+# many mentees for one prompt are sent in chunks, and the chunks' matches are merged. With STREAM_RESPONSES, the
+# matches of a mentor with a single chunk are yielded as GPT writes them, so they must be read before moving on to the
+# next mentor.
+# With a score store, only the mentees that were not scored with the mentor yet are sent, and the new matches are
+# merged with the stored ones.
+# With pack, mentors that are sent with the same mentees share a prompt, and GPT's answer is split between them.
+# All the requests, including the retries, share one rate limiter.
+def match_mentors(mentors, mentor_pools, ai_client=None, max_concurrency=None, cache=None, score_store=None,
+                  metrics_log=None, pack=None):
+    if pack is None:
+        pack = PACK_MENTORS
+    if max_concurrency is None:
+        max_concurrency = MAX_CONCURRENT_REQUESTS
+    rate_limiter = RateLimiter(max_concurrency, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+    if score_store is None:
+        mentor_chunks = [plan_mentee_chunks(mentor, mentor_pools[mentor]) for mentor in mentors]
+    else:
+        unscored_mentees = [score_store.get_unscored_mentees(mentor, mentor_pools[mentor]) for mentor in mentors]
+        mentor_chunks = [plan_mentee_chunks(mentor, mentees) if mentees else []
+                         for mentor, mentees in zip(mentors, unscored_mentees)]
+        new_pairs = sum(len(mentees) for mentees in unscored_mentees)
+        all_pairs = sum(len(mentor_pools[mentor]) for mentor in mentors)
+        print(f"Scoring {new_pairs} new pairs, reusing {all_pairs - new_pairs} stored pairs", file=sys.stderr)
+    mentor_packs = plan_mentor_packs(mentors, mentor_chunks) if pack else {}
+    if mentor_packs:
+        print(f"Packing {len(mentor_packs)} mentors into {len({id(pack) for pack in mentor_packs.values()})} prompts",
+              file=sys.stderr)
+    all_metrics = [MentorMetrics(mentor) for mentor in mentors]
+    prompts = []
+    request_metrics = []
+    for mentor, chunks, mentor_metrics in zip(mentors, mentor_chunks, all_metrics):
+        mentor_pack = mentor_packs.get(mentor)
+        for chunk in chunks:
+            start = time.perf_counter()
+            if mentor_pack is None:
+                prompts.append(prompt + build_mentor_record(mentor, chunk))
+            elif mentor_pack[0] is mentor:
+                prompts.append(prompt + build_packed_record(mentor_pack, chunk))
+            mentor_metrics.build_seconds += time.perf_counter() - start
+            # The prompt and the request of a pack are counted once, for its first mentor
+            if mentor_pack is None or mentor_pack[0] is mentor:
+                mentor_metrics.mentees_per_prompt.append(len(chunk))
+                request_metrics.append(mentor_metrics.new_request())
+    if STREAM_RESPONSES:
+        responses = stream_ai_responses(prompts, ai_client, max_concurrency, rate_limiter, cache, request_metrics)
+    else:
+        responses = (response.split('\n') for response in
+                     get_ai_responses(prompts, ai_client, max_concurrency, rate_limiter, cache, request_metrics))
+    packed_lines = {}
+    for mentor, chunks, mentor_metrics in zip(mentors, mentor_chunks, all_metrics):
+        mentor_pack = mentor_packs.get(mentor)
+        if mentor_pack is not None and mentor_pack[0] is mentor:
+            packed_lines.update(split_packed_matches(mentor_pack, chunks[0], list(next(responses)), ai_client, cache,
+                                                     mentor_metrics, rate_limiter))
+        if score_store is None and len(chunks) == 1:
+            lines = packed_lines.pop(mentor) if mentor_pack is not None else next(responses)
+            yield check_matches(mentor, chunks[0], lines, ai_client, cache, mentor_metrics=mentor_metrics,
+                                rate_limiter=rate_limiter)
+        else:
+            chunk_records = []
+            for chunk in chunks:
+                wrong_lines = []
+                lines = packed_lines.pop(mentor) if mentor_pack is not None else next(responses)
+                records = list(check_matches(mentor, chunk, lines, ai_client, cache, wrong_lines, mentor_metrics,
+                                             rate_limiter))
+                # Pairs GPT gave us a wrong answer for are not stored, so they will be sent again next time
+                if score_store is not None and not wrong_lines:
+                    score_store.save(mentor, chunk, records)
+                chunk_records.append(records)
+            if score_store is not None:
+                chunk_records.append(score_store.get_matches(mentor, mentor_pools[mentor]))
+            if RERANK_CHUNKED_MATCHES and len(chunks) > 1:
+                yield rerank_chunk_matches(mentor, mentor_pools[mentor], chunk_records, ai_client, cache,
+                                           mentor_metrics, rate_limiter)
+            else:
+                yield merge_top_matches(chunk_records)
+        # By now the mentor's matches were read, so all of its requests are done
+        if metrics_log is not None:
+            metrics_log.add(mentor_metrics)
+
+
+# Incremental matching:
+# A hash of everything in the prompt other than the participants, so that stored scores are only reused with the same
+# instructions and model
+def get_prompt_version():
+    return get_cache_key(prompt)
+
+
+# A hash of all of the participant's answers that are sent to GPT. It changes when the participant edits their answers.
+def get_participant_hash(participant):
+    return hashlib.sha256(participant.record.encode('utf-8')).hexdigest()
+
+
+# A SQLite file with every (mentor, mentee) pair that GPT already scored, keyed by the hashes of both participants'
+# answers and the prompt version. Pairs GPT didn't list as one of the mentor's best matches are kept too (with no
+# score), so that we know they don't need to be sent again.
+class ScoreStore:
+    def __init__(self, path=SCORE_STORE_FILE):
+        self.prompt_version = get_prompt_version()
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS scored_pairs ("
+                                "mentor_hash TEXT NOT NULL, mentee_hash TEXT NOT NULL, prompt_version TEXT NOT NULL, "
+                                "line TEXT, PRIMARY KEY (mentor_hash, mentee_hash, prompt_version))")
+        self.connection.commit()
+
+    # Returns a dictionary from mentee hash to the stored match line (or None if GPT didn't list the mentee) for all
+    # the mentees that were already scored with this mentor
+    def get_scored_pairs(self, mentor):
+        rows = self.connection.execute("SELECT mentee_hash, line FROM scored_pairs "
+                                       "WHERE mentor_hash = ? AND prompt_version = ?",
+                                       (get_participant_hash(mentor), self.prompt_version))
+        return dict(rows.fetchall())
+
+    # The mentees in the list that were not scored with this mentor yet
+    def get_unscored_mentees(self, mentor, mentees):
+        scored_pairs = self.get_scored_pairs(mentor)
+        return [mentee for mentee in mentees if get_participant_hash(mentee) not in scored_pairs]
+
+    # Save GPT's matches for the mentor and the mentees that were sent with it
+    def save(self, mentor, mentees, records):
+        lines = {normalize_email(record.mentee_email): record.to_line() for record in records}
+        mentor_hash = get_participant_hash(mentor)
+        self.connection.executemany("INSERT OR REPLACE INTO scored_pairs VALUES (?, ?, ?, ?)",
+                                    [(mentor_hash, get_participant_hash(mentee), self.prompt_version,
+                                      lines.get(normalize_email(mentee.email))) for mentee in mentees])
+        self.connection.commit()
+
+    # All the stored matches of the mentor with the given mentees
+    def get_matches(self, mentor, mentees):
+        scored_pairs = self.get_scored_pairs(mentor)
+        records = []
+        for mentee in mentees:
+            line = scored_pairs.get(get_participant_hash(mentee))
+            if line is not None:
+                records.append(parse_match_line(line))
+        return records
+
+    def close(self):
+        self.connection.close()
+
+
+# Batch mode:
+# For large cohorts, the prompts can be sent with the OpenAI Batch API instead (half the price, and no rate limits, but
+# the results take up to 24 hours). Run with --batch-export batch_requests.jsonl to write all the prompts to a file, and
+# upload it at https://platform.openai.com/batches. When the batch is done, download the output file, and run with
+# --batch-ingest batch_requests.jsonl batch_results.jsonl to print the matches, the same way they are printed when
+# the mentors are sent to GPT directly. Sample files are in fixtures/, and 'python benchmark.py batch' exports and
+# ingests a batch offline.
+
+# The custom_id of every request in the batch is the mentor's email. Mentors that are sent in chunks get one request
+# per chunk (the email, '#' and the chunk number), and a second mentor with the same email gets ' (2)' added to it.
+def get_batch_ids(mentors, mentor_chunks):
+    batch_ids = []
+    used_ids = set()
+    for mentor, chunks in zip(mentors, mentor_chunks):
+        mentor_id = mentor.email.strip() or "row %d" % mentor.row
+        copy_number = 2
+        while mentor_id in used_ids:
+            mentor_id = "%s (%d)" % (mentor.email.strip(), copy_number)
+            copy_number += 1
+        used_ids.add(mentor_id)
+        if len(chunks) == 1:
+            batch_ids.append([mentor_id])
+        else:
+            batch_ids.append(["%s#%d" % (mentor_id, k + 1) for k in range(len(chunks))])
+    return batch_ids
+
+
+# Write a request for every mentor (or every chunk of a mentor) to a JSONL file for the Batch API
+def export_batch(path, mentors, mentor_pools):
+    mentor_chunks = [plan_mentee_chunks(mentor, mentor_pools[mentor]) for mentor in mentors]
+    with open(path, 'w', encoding='utf-8') as batch_file:
+        for mentor, chunks, chunk_ids in zip(mentors, mentor_chunks, get_batch_ids(mentors, mentor_chunks)):
+            for chunk, custom_id in zip(chunks, chunk_ids):
+                request = {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                           "body": get_chat_request(prompt + build_mentor_record(mentor, chunk))}
+                batch_file.write(json.dumps(request) + "\n")
+    print(f"Wrote {sum(len(chunks) for chunks in mentor_chunks)} requests for {len(mentors)} mentors to {path}",
+          file=sys.stderr)
+
+
+# GPT's response in one line of the Batch API output file, or an error message like the one get_ai_response returns
+def read_batch_result(result):
+    if result.get("error"):
+        return f"An error occurred: {result['error'].get('message', result['error'])}"
+    response = result.get("response") or {}
+    if response.get("status_code") != 200:
+        return f"An error occurred: status code {response.get('status_code')}"
+    return response["body"]["choices"][0]["message"]["content"]
+
+
+# Read the Batch API output file, and return the matches for each mentor in the same order as in the requests file.
+# Mentors that were sent in chunks have their chunks' matches merged. Invalid lines are reported, but since the batch
+# is already done they are not sent to GPT again.
+def ingest_batch(requests_path, results_path):
+    mentor_ids = []
+    chunk_ids = {}
+    with open(requests_path, encoding='utf-8') as requests_file:
+        for line in requests_file:
+            if not line.strip():
+                continue
+            custom_id = json.loads(line)["custom_id"]
+            mentor_id, separator, chunk_number = custom_id.rpartition('#')
+            if not separator or not chunk_number.isdigit():
+                mentor_id = custom_id
+            if mentor_id not in chunk_ids:
+                mentor_ids.append(mentor_id)
+                chunk_ids[mentor_id] = []
+            chunk_ids[mentor_id].append(custom_id)
+
+    responses = {}
+    with open(results_path, encoding='utf-8') as results_file:
+        for line in results_file:
+            if line.strip():
+                result = json.loads(line)
+                responses[result["custom_id"]] = read_batch_result(result)
+
+    matches = []
+    for mentor_id in mentor_ids:
+        chunk_records = []
+        for custom_id in chunk_ids[mentor_id]:
+            records = []
+            for line in responses.get(custom_id, f"An error occurred: no result for {custom_id}").split('\n'):
+                if not line.strip():
+                    continue
+                try:
+                    records.append(parse_match_line(line.strip()))
+                except ValueError as e:
+                    print(f"Invalid line for {custom_id}: {e}", file=sys.stderr)
+            chunk_records.append(records)
+        matches.append(merge_top_matches(chunk_records))
+    return matches
+
+
+# Collect all the matches into a sparse score matrix, with a row for every mentor and a column for every mentee.
+# Returns the mentor emails, the mentee emails, the matrix, and the match record of every (row, column).
+def build_score_matrix(matches, never_pair=None):
+    if never_pair is None:
+        never_pair = NEVER_PAIR
+    never_pair = {(normalize_email(mentor_email), normalize_email(mentee_email))
+                  for mentor_email, mentee_email in never_pair}
+    mentor_ids = {}
+    mentee_ids = {}
+    records = {}
+    for mentor_matches in matches:
+        for record in mentor_matches:
+            mentor_email = normalize_email(record.mentor_email)
+            mentee_email = normalize_email(record.mentee_email)
+            if (mentor_email, mentee_email) in never_pair or record.overall_score <= 0:
+                continue
+            m = mentor_ids.setdefault(mentor_email, len(mentor_ids))
+            n = mentee_ids.setdefault(mentee_email, len(mentee_ids))
+            if (m, n) not in records or record.overall_score > records[m, n].overall_score:
+                records[m, n] = record
+    rows = [m for m, n in records]
+    cols = [n for m, n in records]
+    scores = [record.overall_score for record in records.values()]
+    score_matrix = sparse.csr_matrix((scores, (rows, cols)), shape=(len(mentor_ids), len(mentee_ids)))
+    return list(mentor_ids), list(mentee_ids), score_matrix, records
+
+
+# Pick the pairs with the highest total score, where every mentee gets at most one mentor and every mentor at most their
+# capacity. Every mentor is repeated once per mentee they can take, and the Hungarian algorithm (scipy's
+# linear_sum_assignment) picks the best one to one assignment. Returns the picked match records, sorted by mentor.
+def assign_pairs(matches, mentor_capacities=None, never_pair=None):
+    if mentor_capacities is None:
+        mentor_capacities = MENTOR_CAPACITIES
+    mentor_capacities = {normalize_email(email): capacity for email, capacity in mentor_capacities.items()}
+    start = time.perf_counter()
+    mentor_emails, mentee_emails, score_matrix, records = build_score_matrix(matches, never_pair)
+    slot_mentors = np.repeat(np.arange(len(mentor_emails)),
+                             [mentor_capacities.get(email, MENTOR_CAPACITY) for email in mentor_emails])
+    # Only the mentors' slots are repeated, the matrix itself stays sparse until here
+    slot_scores = score_matrix[slot_mentors].toarray()
+    slot_rows, cols = linear_sum_assignment(slot_scores, maximize=True)
+    pairs = [records[slot_mentors[slot], n] for slot, n in zip(slot_rows, cols) if slot_scores[slot, n] > 0]
+    elapsed = time.perf_counter() - start
+    total_score = sum(record.overall_score for record in pairs)
+    print(f"Assigned {len(pairs)} pairs ({len(mentor_emails)} mentors, {len(mentee_emails)} mentees, "
+          f"{score_matrix.nnz} scored pairs) in {elapsed:.2f} seconds, total score {total_score}", file=sys.stderr)
+    mentor_order = {email: m for m, email in enumerate(mentor_emails)}
+    return sorted(pairs, key=lambda record: mentor_order[normalize_email(record.mentor_email)])
+
+
+# Print the final pairs after the matches, so that they can be copied to their own spreadsheet
+def print_assigned_pairs(matches):
+    pairs = assign_pairs(matches)
+    print()
+    print("Assigned pairs:")
+    for record in pairs:
+        print(record.to_line())
+    return pairs
+
+
+# Send every mentor to GPT and print the matches, in the same order as the mentors appear in the spreadsheet.
+# Returns the matches for each mentor.
+def run_matching(participants, ai_client=None, max_concurrency=None, cache=None, shortlist_size=None,
+                 score_store=None, metrics_log=None, pack=None):
+    if metrics_log is None:
+        metrics_log = MetricsLog()
+    gender_index = GenderIndex(participants)
+    mentor_pools = get_mentor_pools(gender_index, shortlist_size)
+    matches = []
+    for mentor_matches in match_mentors(gender_index.mentors, mentor_pools, ai_client, max_concurrency, cache,
+                                        score_store, metrics_log, pack):
+        records = []
+        for record in mentor_matches:
+            print(record.to_line(), flush=True)
+            records.append(record)
+        matches.append(records)
+    if cache is not None:
+        # Printed to stderr, so that the matches in the output can still be copied to a spreadsheet as is
+        print(f"Cache: {cache.hits} hits, {cache.misses} misses", file=sys.stderr)
+    metrics_log.print_summary()
+    return matches
+
+
 # Initialize the client with your API key
 client = OpenAI(api_key="XXX") #put in actual key
 
-# Read the spreadsheet
-response_spreadsheet = access_spreadsheet()
-
-for j in range(1, len(response_spreadsheet)):
-    # Get the next mentor
-    mentor_counter = 0
-    mentee_counter = 0
-    if "Mentor" in str(response_spreadsheet[j][ROLE_COL]):
-        current_record = "Here is the Mentor record: \n"
-        mentor_counter += 1
-        current_record += " First name: " + response_spreadsheet[j][FIRST_NAME_COL]
-        current_record += "\n"
-        current_record += " Last name: " + response_spreadsheet[j][LAST_NAME_COL]
-        current_record += "\n"
-        current_record += " email: " + response_spreadsheet[j][EMAIL_COL]
-        current_record += "\n"
-        current_record += " City: " + response_spreadsheet[j][CITY_COL]
-        current_record += "\n"
-        current_record += " State: " + response_spreadsheet[j][STATE_COL]
-        current_record += "\n"
-        current_record += " Meeting location preference: " + response_spreadsheet[j][MEETING_LOCATION_COL]
-        current_record += "\n"
-        current_record += " Meeting type preference: " + response_spreadsheet[j][MEETING_PREFERENCE_COL]
-        current_record += "\n"
-        current_record += " Gender: " + response_spreadsheet[j][GENDER_COL]
-        current_record += "\n"
-        current_record += " Gender preference: " + response_spreadsheet[j][GENDER_PREFERENCE_COL]
-        current_record += "\n"
-        current_record += " Occupation: " + response_spreadsheet[j][OCCUPATION_COL]
-        current_record += "\n"
-        current_record += " Affiliation: " + response_spreadsheet[j][AFFILIATION_COL]
-        current_record += "\n"
-        current_record += " Company: " + response_spreadsheet[j][COMPANY_COL]
-        current_record += "\n"
-        current_record += " Industry: " + response_spreadsheet[j][INDUSTRY_COL]
-        current_record += "\n"
-        current_record += " Work history: " + response_spreadsheet[j][WORK_HISTORY_COL]
-        current_record += "\n"
-        current_record += " Career path: " + response_spreadsheet[j][CAREER_PATH_COL]
-        current_record += "\n"
-        current_record += " Education: " + response_spreadsheet[j][EDUCATION_COL]
-        current_record += "\n"
-        current_record += " Higher education: " + response_spreadsheet[j][HIGHER_EDUCATION_COL]
-        current_record += "\n"
-        current_record += " Degree: " + response_spreadsheet[j][DEGREE_COL]
-        current_record += "\n"
-        current_record += " Values: " + response_spreadsheet[j][VALUES_COL]
-        current_record += "\n"
-        current_record += " About me: " + response_spreadsheet[j][ABOUT_ME_COL]
-        current_record += "\n"
-        current_record += " Hobbies: " + response_spreadsheet[j][HOBBIES_COL]
-        current_record += "\n"
-        current_record += " Focus area: " + response_spreadsheet[j][FOCUS_AREA_COL]
-        current_record += "\n"
-        current_record += " Expectations and hopes: " + response_spreadsheet[j][ANSWER_Q1_EXPECTATIONS_AND_HOPES_COL]
-        current_record += "\n"
-        current_record += " Would you like to add anything else? " + \
-                          response_spreadsheet[j][ANSWER_Q2_ANYTHING_ELSE_COL]
-        current_record += "\n"
-
-        current_record += "And here is the list of Mentee records: \n"
-        for i in range(1, len(response_spreadsheet)):
-
-            # Add this record to the prompt only if this is a Mentee record, and there is a gender match.
-            #
-            if "Mentee" in str(response_spreadsheet[i][ROLE_COL]) and \
-                    is_gender_match(response_spreadsheet[i][GENDER_COL],
-                                    response_spreadsheet[i][GENDER_PREFERENCE_COL],
-                                    response_spreadsheet[j][GENDER_COL],
-                                    response_spreadsheet[j][GENDER_PREFERENCE_COL]):
-                # Build the mentee record
-                mentee_counter += 1
-                current_record += " First name: " + response_spreadsheet[i][FIRST_NAME_COL]
-                current_record += "\n"
-                current_record += " Last name: " + response_spreadsheet[i][LAST_NAME_COL]
-                current_record += "\n"
-                current_record += " email: " + response_spreadsheet[i][EMAIL_COL]
-                current_record += "\n"
-                current_record += " City: " + response_spreadsheet[i][CITY_COL]
-                current_record += "\n"
-                current_record += " State: " + response_spreadsheet[i][STATE_COL]
-                current_record += "\n"
-                current_record += " Meeting location preference: " + response_spreadsheet[i][MEETING_LOCATION_COL]
-                current_record += "\n"
-                current_record += " Meeting type preference: " + response_spreadsheet[i][MEETING_PREFERENCE_COL]
-                current_record += "\n"
-                current_record += " Gender: " + response_spreadsheet[i][GENDER_COL]
-                current_record += "\n"
-                current_record += " Gender preference: " + response_spreadsheet[i][GENDER_PREFERENCE_COL]
-                current_record += "\n"
-                current_record += " Occupation: " + response_spreadsheet[i][OCCUPATION_COL]
-                current_record += "\n"
-                current_record += " Affiliation: " + response_spreadsheet[i][AFFILIATION_COL]
-                current_record += "\n"
-                current_record += " Company: " + response_spreadsheet[i][COMPANY_COL]
-                current_record += "\n"
-                current_record += " Industry: " + response_spreadsheet[i][INDUSTRY_COL]
-                current_record += "\n"
-                current_record += " Work history: " + response_spreadsheet[i][WORK_HISTORY_COL]
-                current_record += "\n"
-                current_record += " Career path: " + response_spreadsheet[i][CAREER_PATH_COL]
-                current_record += "\n"
-                current_record += " Education: " + response_spreadsheet[i][EDUCATION_COL]
-                current_record += "\n"
-                current_record += " Higher education: " + response_spreadsheet[i][HIGHER_EDUCATION_COL]
-                current_record += "\n"
-                current_record += " Degree: " + response_spreadsheet[i][DEGREE_COL]
-                current_record += "\n"
-                current_record += " Values: " + response_spreadsheet[i][VALUES_COL]
-                current_record += "\n"
-                current_record += " About me: " + response_spreadsheet[i][ABOUT_ME_COL]
-                current_record += "\n"
-                current_record += " Hobbies: " + response_spreadsheet[i][HOBBIES_COL]
-                current_record += "\n"
-                current_record += " Focus area: " + response_spreadsheet[i][FOCUS_AREA_COL]
-                current_record += "\n"
-                current_record += " Expectations and hopes: " + \
-                                  response_spreadsheet[i][ANSWER_Q1_EXPECTATIONS_AND_HOPES_COL]
-                current_record += "\n"
-                current_record += " Would you like to add anything else? " + \
-                                  response_spreadsheet[i][ANSWER_Q2_ANYTHING_ELSE_COL]
-                current_record += "\n"
-
-        # Print for debugging
-        # print(prompt + current_record)
-        # print("Current Mentor: " + response_spreadsheet[j][FIRST_NAME_COL])
-        # print("Number of Mentors: " + str(mentor_counter))
-        # print("Number of Mentees: " + str(mentee_counter))
-        # print("Total records: " + str(mentee_counter + mentor_counter))
-        # print("Length of prompt [chars]: " + str(len(prompt + current_record)))
-        # print("Number of words in prompt: " + str(len(prompt.split()) + len(current_record.split())))
-        # print("Number of OAI tokens in prompt (by chars): " + str(len(prompt+current_record)/4))
-        # print("Number of OAI tokens in prompt (by word): " + str(len(prompt.split()) + len(current_record.split()) / 1.3))
-        openai_matching = get_ai_response(prompt + current_record)
-        csv_output = remove_empty_lines(openai_matching)
-        print(csv_output)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Match mentors and mentees using GPT")
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write the cached GPT responses")
+    parser.add_argument('--refresh', action='store_true', help="ask GPT again and overwrite the cached responses")
+    parser.add_argument('--recall-report', action='store_true',
+                        help="send all the mentees to GPT, and report how many of its matches are in the shortlist")
+    parser.add_argument('--batch-export', metavar='REQUESTS_FILE',
+                        help="write the prompts to a JSONL file for the OpenAI Batch API, instead of sending them")
+    parser.add_argument('--batch-ingest', nargs=2, metavar=('REQUESTS_FILE', 'RESULTS_FILE'),
+                        help="print the matches from the Batch API output file")
+    parser.add_argument('--write-results', action='store_true',
+                        help="write the matches back to the spreadsheet, in the '%s' tab" % MATCHES_RANGE_NAME)
+    parser.add_argument('--incremental', action='store_true',
+                        help="only send GPT the pairs that were not scored before, and reuse the stored scores")
+    parser.add_argument('--pack', action='store_true',
+                        help="send mentors that have the same mentees to GPT together, in one prompt")
+    parser.add_argument('--pack-report', action='store_true',
+                        help="match with and without packing, and report how much the matches agree")
+    parser.add_argument('--metrics', metavar='METRICS_FILE',
+                        help="write the metrics of every mentor to a JSONL file")
+    parser.add_argument('--assign', action='store_true',
+                        help="after the matches, print the final pairs with the highest total score")
+    args = parser.parse_args()
 
+    if args.batch_ingest:
+        # The batch results have everything we need, no need to read the spreadsheet
+        matches = ingest_batch(*args.batch_ingest)
+        for records in matches:
+            for record in records:
+                print(record.to_line())
+        pairs = print_assigned_pairs(matches) if args.assign else None
+        if args.write_results:
+            write_results(matches, pairs)
+        sys.exit()
+
+    response_cache = None
+    if not args.no_cache:
+        response_cache = ResponseCache(refresh=args.refresh)
+
+    # Read the spreadsheet. If we are going to write to it, we need write access for reading too, so that the same
+    # service can be used for both.
+    sheets_service = get_google_service('sheets', 'v4', WRITE_SCOPES if args.write_results else SCOPES)
+    response_spreadsheet = access_spreadsheet(sheets_service)
+    participants = read_participants(response_spreadsheet)
+    if args.batch_export:
+        gender_index = GenderIndex(participants)
+        export_batch(args.batch_export, gender_index.mentors, get_mentor_pools(gender_index))
+    elif args.pack_report:
+        single_matches = run_matching(participants, cache=response_cache, pack=False)
+        packed_matches = run_matching(participants, cache=response_cache, pack=True)
+        print_packing_agreement(single_matches, packed_matches)
+    elif args.recall_report:
+        full_pool_matches = run_matching(participants, cache=response_cache, shortlist_size=0)
+        print_shortlist_recall(GenderIndex(participants), full_pool_matches,
+                               sorted({10, 20, SHORTLIST_SIZE or 50, 100}))
+    else:
+        score_store = None
+        if args.incremental:
+            score_store = ScoreStore()
+        matches = run_matching(participants, cache=response_cache, score_store=score_store,
+                               metrics_log=MetricsLog(args.metrics), pack=args.pack or None)
+        pairs = print_assigned_pairs(matches) if args.assign else None
+        if args.write_results:
+            write_results(matches, pairs, sheets_service)
+        if score_store is not None:
+            score_store.close()
+    if response_cache is not None:
+        response_cache.close()
@@ -0,0 +1,537 @@
+# Benchmarks for the matching script. They run on a synthetic spreadsheet, so they don't need access to Google Sheets
+# or to GPT.
+#
+#    Run from the project's directory:
+#    python benchmark.py prompts --mentors 1000 --mentees 1000
+#    python benchmark.py pipeline --participants 100 1000 10000
+#    python benchmark.py pipeline --participants 100 --pack
+#    python benchmark.py batch
+#    python benchmark.py sheets --participants 7 --page-rows 3
+#    python benchmark.py concurrency --prompts 40 --latency 0.05 --rate-limit-every 7
+#
+#    The batch, sheets and concurrency runs check their results, and exit with an error if something is wrong.
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import Matchmaking
+
+# Sample Batch API files: a requests file and its output file, with a mentor sent in two chunks, an invalid line and a
+# failed request
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BATCH_REQUESTS_FIXTURE = os.path.join(FIXTURES_DIR, 'batch_requests.jsonl')
+BATCH_RESULTS_FIXTURE = os.path.join(FIXTURES_DIR, 'batch_results.jsonl')
+
+# Answers for the synthetic participants
+OCCUPATIONS = ["Software engineer", "Marketing manager", "Accountant", "Writer", "Nurse", "Product manager",
+               "Sales executive", "Data scientist", "Lawyer", "Teacher", "Physician", "Business owner"]
+INDUSTRIES = ["Technology", "Healthcare", "Finance", "Education", "Retail", "Media", "Medical devices", "Legal"]
+SUBJECTS = ["Computer science", "Communications", "Marketing", "Accounting", "History", "Biology", "Economics",
+            "Archaeology", "Data science", "Law"]
+VALUES = ["Family", "Community", "Growth", "Tradition", "Innovation", "Kindness", "Giving back", "Learning", "Faith"]
+HOBBIES = ["Hiking", "Cooking", "Reading", "Running", "Music", "Travel", "Chess", "Photography", "Gardening"]
+CITIES = [("San Francisco", "California"), ("Palo Alto", "California"), ("Sunnyvale", "California"),
+          ("Los Angeles", "California"), ("San Diego", "California"), ("New York", "New York"),
+          ("Boston", "Massachusetts"), ("Chicago", "Illinois"), ("Seattle", "Washington"), ("Austin", "Texas")]
+MEETING_LOCATIONS = ["Coffee shop", "Office", "Anywhere"]
+MEETING_TYPES = ["In person only", "Zoom only", "In person or Zoom"]
+GENDERS = ["Male", "Female"]
+GENDER_PREFERENCES = ["Male", "Female", "No preference", "No Preference "]
+AFFILIATIONS = ["Reform", "Conservative", "Orthodox", "Secular", ""]
+
+
+# Build a spreadsheet with the same columns as the 'Form Responses' tab, with random answers
+def make_synthetic_spreadsheet(num_mentors, num_mentees, seed=0):
+    rng = random.Random(seed)
+    num_cols = Matchmaking.ANSWER_Q2_ANYTHING_ELSE_COL + 1
+    spreadsheet = [["Header %d" % col for col in range(num_cols)]]
+    for k in range(num_mentors + num_mentees):
+        row = [""] * num_cols
+        row[Matchmaking.ROLE_COL] = "Mentor" if k < num_mentors else "Mentee"
+        row[Matchmaking.FIRST_NAME_COL] = "First%d" % k
+        row[Matchmaking.LAST_NAME_COL] = "Last%d" % k
+        row[Matchmaking.EMAIL_COL] = "participant%d@example.org" % k
+        row[Matchmaking.CITY_COL], row[Matchmaking.STATE_COL] = rng.choice(CITIES)
+        row[Matchmaking.MEETING_LOCATION_COL] = rng.choice(MEETING_LOCATIONS)
+        row[Matchmaking.MEETING_PREFERENCE_COL] = rng.choice(MEETING_TYPES)
+        row[Matchmaking.GENDER_COL] = rng.choice(GENDERS)
+        row[Matchmaking.GENDER_PREFERENCE_COL] = rng.choice(GENDER_PREFERENCES)
+        row[Matchmaking.OCCUPATION_COL] = rng.choice(OCCUPATIONS)
+        row[Matchmaking.AFFILIATION_COL] = rng.choice(AFFILIATIONS)
+        row[Matchmaking.COMPANY_COL] = "Company %d" % rng.randrange(50)
+        row[Matchmaking.INDUSTRY_COL] = rng.choice(INDUSTRIES)
+        row[Matchmaking.WORK_HISTORY_COL] = ", ".join(rng.sample(OCCUPATIONS, 2))
+        row[Matchmaking.CAREER_PATH_COL] = rng.choice(OCCUPATIONS)
+        row[Matchmaking.EDUCATION_COL] = "College"
+        row[Matchmaking.HIGHER_EDUCATION_COL] = rng.choice(["Bachelor", "Master", "PhD"])
+        row[Matchmaking.DEGREE_COL] = rng.choice(SUBJECTS)
+        row[Matchmaking.VALUES_COL] = ", ".join(rng.sample(VALUES, 3))
+        row[Matchmaking.ABOUT_ME_COL] = "I work in %s and care about %s." % (rng.choice(INDUSTRIES).lower(),
+                                                                           rng.choice(VALUES).lower())
+        row[Matchmaking.HOBBIES_COL] = ", ".join(rng.sample(HOBBIES, 2))
+        row[Matchmaking.FOCUS_AREA_COL] = rng.choice(OCCUPATIONS)
+        row[Matchmaking.ANSWER_Q1_EXPECTATIONS_AND_HOPES_COL] = "Grow as a %s." % rng.choice(OCCUPATIONS).lower()
+        row[Matchmaking.ANSWER_Q2_ANYTHING_ELSE_COL] = rng.choice(["", "", "Would like a mentor who owns a business."])
+        # Sheets leaves out the empty cells at the end of a row
+        while row and row[-1] == "":
+            row.pop()
+        spreadsheet.append(row)
+    return spreadsheet
+
+
+# Build the prompts the way the script used to: the mentee records are rebuilt, field by field, for every mentor
+def build_prompts_legacy(spreadsheet):
+    total_length = 0
+    for j in range(1, len(spreadsheet)):
+        if "Mentor" not in str(spreadsheet[j][Matchmaking.ROLE_COL]):
+            continue
+        current_record = "Here is the Mentor record: \n"
+        for name, col, label in Matchmaking.PARTICIPANT_FIELDS:
+            current_record += label + Matchmaking.get_cell(spreadsheet[j], col)
+            current_record += "\n"
+        current_record += "And here is the list of Mentee records: \n"
+        for i in range(1, len(spreadsheet)):
+            if "Mentee" in str(spreadsheet[i][Matchmaking.ROLE_COL]) and \
+                    Matchmaking.is_gender_match(spreadsheet[i][Matchmaking.GENDER_COL],
+                                                spreadsheet[i][Matchmaking.GENDER_PREFERENCE_COL],
+                                                spreadsheet[j][Matchmaking.GENDER_COL],
+                                                spreadsheet[j][Matchmaking.GENDER_PREFERENCE_COL]):
+                for name, col, label in Matchmaking.PARTICIPANT_FIELDS:
+                    current_record += label + Matchmaking.get_cell(spreadsheet[i], col)
+                    current_record += "\n"
+        total_length += len(Matchmaking.prompt + current_record)
+    return total_length
+
+
+# Build the prompts from the participant table, with the records rendered once
+def build_prompts(spreadsheet):
+    participants = Matchmaking.read_participants(spreadsheet)
+    gender_index = Matchmaking.GenderIndex(participants)
+    total_length = 0
+    for mentor in gender_index.mentors:
+        mentees = gender_index.compatible_mentees(mentor)
+        total_length += len(Matchmaking.prompt + Matchmaking.build_mentor_record(mentor, mentees))
+    return total_length
+
+
+# Time building the prompts of every mentor (with all the gender compatible mentees, no shortlist)
+def benchmark_prompts(num_mentors, num_mentees, legacy=True):
+    spreadsheet = make_synthetic_spreadsheet(num_mentors, num_mentees)
+    print(f"Building prompts for {num_mentors} mentors x {num_mentees} mentees")
+    start = time.perf_counter()
+    total_length = build_prompts(spreadsheet)
+    elapsed = time.perf_counter() - start
+    print(f"  participant table: {elapsed:.2f} seconds, {total_length / 1e6:.0f}M characters")
+    if legacy:
+        start = time.perf_counter()
+        legacy_total_length = build_prompts_legacy(spreadsheet)
+        legacy_elapsed = time.perf_counter() - start
+        print(f"  row by row:        {legacy_elapsed:.2f} seconds, {legacy_total_length / 1e6:.0f}M characters "
+              f"({legacy_elapsed / elapsed:.1f}x slower)")
+
+
+# Raise an error (so the run exits with an error) if a check failed
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+# A 429 error like the ones the OpenAI client raises, with a 'retry-after' header if retry_after is given
+class FakeRateLimitError(Exception):
+    status_code = 429
+
+    def __init__(self, retry_after=None):
+        super().__init__("Rate limit reached")
+        self.response = SimpleNamespace(headers={} if retry_after is None else {'retry-after': str(retry_after)})
+
+
+# Stands in for the OpenAI client: answers every prompt with the top 10 mentees, with scores that only depend on the
+# emails, so that every run gives the same matches. The answers have a usage like the API's, and can be streamed.
+# Every request takes latency seconds, and with rate_limit_every, every rate_limit_every-th request fails with a 429
+# error instead. It keeps track of the most requests that were in flight at once.
+class FakeChatClient:
+    def __init__(self, latency=0.0, rate_limit_every=0, retry_after=None):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.requests = 0
+        self.rate_limited = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    @staticmethod
+    def get_score(mentor_email, mentee_email):
+        digest = hashlib.sha256(f"{mentor_email}|{mentee_email}".encode('utf-8')).digest()
+        return digest[0] % 41
+
+    @classmethod
+    def answer_mentor(cls, mentor_record, mentees):
+        mentor_email = re.search(r" email: (.*)\n", mentor_record).group(1)
+        mentor_name = re.search(r" First name: (.*)\n", mentor_record).group(1)
+        scored = sorted(((cls.get_score(mentor_email, email), first_name + " " + last_name, email)
+                         for first_name, last_name, email in mentees), reverse=True)
+        return [f"{mentor_name}; {mentor_email}; {name}; {email}; {score} / 40; Occupation {score // 4} /10; "
+                f"Education {score // 4} / 10; Values {score // 4} / 10; Anything else {score // 4} / 10; "
+                f"Synthetic match"
+                for score, name, email in scored[:Matchmaking.MATCHES_PER_MENTOR]]
+
+    def answer(self, text):
+        mentee_pattern = r" First name: (.*)\n Last name: (.*)\n email: (.*)\n"
+        if Matchmaking.PACKED_MENTOR_RECORDS_HEADER in text:
+            mentee_part, mentor_part = text.split(Matchmaking.PACKED_MENTEE_RECORDS_HEADER, 1)[1].split(
+                Matchmaking.PACKED_MENTOR_RECORDS_HEADER, 1)
+            mentor_records = [" First name: " + record for record in mentor_part.split(" First name: ")[1:]]
+        else:
+            mentor_part, mentee_part = text.split(Matchmaking.MENTEE_RECORDS_HEADER, 1)
+            mentor_records = [mentor_part]
+        mentees = re.findall(mentee_pattern, mentee_part)
+        return "\n".join(line for mentor_record in mentor_records
+                         for line in self.answer_mentor(mentor_record, mentees))
+
+    def create(self, messages, stream=False, **kwargs):
+        with self.lock:
+            self.requests += 1
+            if self.rate_limit_every and self.requests % self.rate_limit_every == 0:
+                self.rate_limited += 1
+                raise FakeRateLimitError(self.retry_after)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        text = messages[0]["content"]
+        content = self.answer(text)
+        usage = SimpleNamespace(prompt_tokens=Matchmaking.estimate_tokens(text),
+                                completion_tokens=Matchmaking.estimate_tokens(content))
+        if not stream:
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+        return self.stream(content, usage)
+
+    @staticmethod
+    def stream(content, usage):
+        for line in content.splitlines(keepends=True):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=line))], usage=None)
+        yield SimpleNamespace(choices=[], usage=usage)
+
+
+# Run the whole pipeline (reading the participants, the gender index and the shortlists, GPT and the assignment) on a
+# synthetic cohort, with a fake GPT client, and print how long every stage took
+def benchmark_pipeline(num_participants, latency=0.0, max_concurrency=None, metrics_path=None, pack=False):
+    # The fake client has no rate limits
+    Matchmaking.REQUESTS_PER_MINUTE = Matchmaking.TOKENS_PER_MINUTE = 10 ** 12
+    spreadsheet = make_synthetic_spreadsheet(num_participants // 2, num_participants - num_participants // 2)
+    ai_client = FakeChatClient(latency)
+    print(f"Pipeline for {num_participants} participants")
+    stages = []
+    start = time.perf_counter()
+    participants = Matchmaking.read_participants(spreadsheet)
+    stages.append(("reading participants", time.perf_counter() - start))
+    start = time.perf_counter()
+    gender_index = Matchmaking.GenderIndex(participants)
+    mentor_pools = Matchmaking.get_mentor_pools(gender_index)
+    stages.append(("gender index and shortlists", time.perf_counter() - start))
+    start = time.perf_counter()
+    metrics_log = Matchmaking.MetricsLog(metrics_path)
+    matches = [list(records) for records in Matchmaking.match_mentors(gender_index.mentors, mentor_pools, ai_client,
+                                                                      max_concurrency, metrics_log=metrics_log,
+                                                                      pack=pack)]
+    stages.append(("matching (%d requests)" % ai_client.requests, time.perf_counter() - start))
+    start = time.perf_counter()
+    pairs = Matchmaking.assign_pairs(matches)
+    stages.append(("assigning %d pairs" % len(pairs), time.perf_counter() - start))
+    for stage, elapsed in stages:
+        print(f"  {stage + ':':40} {elapsed:.2f} seconds")
+    metrics_log.print_summary()
+
+
+# Answer every request in a Batch API requests file with the fake client, and write them to an output file in the
+# Batch API's format
+def write_fake_batch_results(requests_path, results_path, ai_client):
+    with open(requests_path, encoding='utf-8') as requests_file, \
+            open(results_path, 'w', encoding='utf-8') as results_file:
+        for n, line in enumerate(requests_file):
+            request = json.loads(line)
+            response = ai_client.create(**request["body"])
+            body = {"object": "chat.completion", "model": request["body"]["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant",
+                                                         "content": response.choices[0].message.content},
+                                 "finish_reason": "stop"}],
+                    "usage": vars(response.usage)}
+            result = {"id": "batch_req_%d" % n, "custom_id": request["custom_id"],
+                      "response": {"status_code": 200, "body": body}, "error": None}
+            results_file.write(json.dumps(result) + "\n")
+
+
+# Export the prompts of a synthetic cohort for the Batch API, answer them with the fake client and read the matches
+# back, and then read the sample files in fixtures/. Needs no network access.
+def benchmark_batch(num_participants, requests_path=None, results_path=None):
+    check_fixtures = requests_path is None
+    if requests_path is None:
+        requests_path, results_path = BATCH_REQUESTS_FIXTURE, BATCH_RESULTS_FIXTURE
+    spreadsheet = make_synthetic_spreadsheet(num_participants // 2, num_participants - num_participants // 2)
+    gender_index = Matchmaking.GenderIndex(Matchmaking.read_participants(spreadsheet))
+    mentor_pools = Matchmaking.get_mentor_pools(gender_index)
+    print(f"Batch round trip for {num_participants} participants")
+    with tempfile.TemporaryDirectory() as directory:
+        synthetic_requests_path = os.path.join(directory, 'batch_requests.jsonl')
+        synthetic_results_path = os.path.join(directory, 'batch_results.jsonl')
+        start = time.perf_counter()
+        Matchmaking.export_batch(synthetic_requests_path, gender_index.mentors, mentor_pools)
+        export_elapsed = time.perf_counter() - start
+        write_fake_batch_results(synthetic_requests_path, synthetic_results_path, FakeChatClient())
+        start = time.perf_counter()
+        matches = Matchmaking.ingest_batch(synthetic_requests_path, synthetic_results_path)
+        ingest_elapsed = time.perf_counter() - start
+    print(f"  export: {export_elapsed:.2f} seconds, ingest: {ingest_elapsed:.2f} seconds, "
+          f"{sum(len(records) for records in matches)} matches for {len(matches)} mentors")
+    # The same matches as sending the prompts right away (the order of mentees with the same score may differ)
+    Matchmaking.REQUESTS_PER_MINUTE = Matchmaking.TOKENS_PER_MINUTE = 10 ** 12
+    online_matches = Matchmaking.match_mentors(gender_index.mentors, mentor_pools, FakeChatClient(), pack=False)
+    check(len(matches) == len(gender_index.mentors), f"{len(matches)} mentors in the batch results instead of "
+                                                     f"{len(gender_index.mentors)}")
+    for mentor, records, online_records in zip(gender_index.mentors, matches, online_matches):
+        check(sorted(record.to_row() for record in records) == sorted(record.to_row() for record in online_records),
+              f"the batch matches for {mentor.email} are not the same as the matches sent right away")
+
+    print(f"Sample files {requests_path} and {results_path}")
+    errors = io.StringIO()
+    with contextlib.redirect_stderr(errors):
+        matches = Matchmaking.ingest_batch(requests_path, results_path)
+    print(errors.getvalue(), end="", file=sys.stderr)
+    for records in matches:
+        print(f"  {len(records)} matches" + (f" for {records[0].mentor_email}" if records else ""))
+        for record in records:
+            print("    " + record.to_line())
+    if check_fixtures:
+        # participant1 was sent in two chunks, the first with an invalid line, and the request for participant2 failed
+        mentee_numbers = [[int(re.search(r"\d+", record.mentee_email).group()) for record in records]
+                          for records in matches]
+        check(mentee_numbers == [[5, 7, 4, 3, 8, 6], [6, 5, 7, 8, 3, 4], []],
+              f"the sample files' matches are {mentee_numbers}")
+        check("Invalid line for participant1@example.org#1" in errors.getvalue(), "the invalid line was not reported")
+        check("Invalid line for participant2@example.org: An error occurred" in errors.getvalue(),
+              "the failed request was not reported")
+
+
+# Stands in for the Google Sheets API service (and the Drive API service, for the modification time), with the tabs
+# kept in memory. Supports the requests the script sends: values().batchGet by columns, batchClear and batchUpdate.
+class FakeSheetsService:
+    def __init__(self, tabs, modified_time="2024-01-01T00:00:00.000Z"):
+        self.tabs = tabs
+        self.modified_time = modified_time
+        self.requests = []
+
+    # The API objects are chained like the real ones: service.spreadsheets().values().batchGet(...).execute()
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def files(self):
+        return self
+
+    def request(self, name, result):
+        self.requests.append(name)
+        return SimpleNamespace(execute=lambda: result)
+
+    @staticmethod
+    def column_number(letters):
+        number = 0
+        for letter in letters:
+            number = number * 26 + ord(letter) - ord('A') + 1
+        return number - 1
+
+    # Like the real API, trailing empty cells are left out, and a range without values has no 'values'
+    def batchGet(self, spreadsheetId, ranges, majorDimension):
+        value_ranges = []
+        for value_range in ranges:
+            tab, first_col, first_row, last_col, last_row = re.fullmatch(r"'(.+)'!([A-Z]+)(\d+):([A-Z]+)(\d+)",
+                                                                         value_range).groups()
+            assert majorDimension == 'COLUMNS' and first_col == last_col
+            col = self.column_number(first_col)
+            values = [str(Matchmaking.get_cell(row, col))
+                      for row in self.tabs.get(tab, [])[int(first_row) - 1:int(last_row)]]
+            while values and values[-1] == "":
+                values.pop()
+            value_ranges.append({"range": value_range, "majorDimension": majorDimension,
+                                 **({"values": [values]} if values else {})})
+        return self.request('batchGet', {"spreadsheetId": spreadsheetId, "valueRanges": value_ranges})
+
+    def batchClear(self, spreadsheetId, body):
+        for tab in body["ranges"]:
+            self.tabs[tab.strip("'")] = []
+        return self.request('batchClear', {})
+
+    def batchUpdate(self, spreadsheetId, body):
+        for data in body["data"]:
+            tab, start = data["range"].rsplit('!', 1)
+            assert start == "A1"
+            self.tabs[tab.strip("'")] = [list(row) for row in data["values"]]
+        return self.request('batchUpdate', {})
+
+    # The Drive API's files().get(), for the modification time
+    def get(self, fileId, fields):
+        return self.request('get', {"modifiedTime": self.modified_time})
+
+
+# Read a synthetic spreadsheet through the fake Sheets service in pages, read it again from the snapshot, and write
+# the matches and pairs back to it. Needs no network access.
+def benchmark_sheets(num_participants, page_rows):
+    spreadsheet = make_synthetic_spreadsheet(num_participants // 2, num_participants - num_participants // 2)
+    service = FakeSheetsService({Matchmaking.RANGE_NAME: spreadsheet})
+    expected_records = [participant.record for participant in Matchmaking.read_participants(spreadsheet)]
+    Matchmaking.SHEETS_PAGE_ROWS = page_rows
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot_file = os.path.join(directory, 'snapshot.json')
+        for attempt in ["first read", "unchanged spreadsheet", "modified spreadsheet"]:
+            if attempt == "modified spreadsheet":
+                service.modified_time = "2024-01-02T00:00:00.000Z"
+            service.requests = []
+            values = Matchmaking.access_spreadsheet(service, service, snapshot_file)
+            records = [participant.record for participant in Matchmaking.read_participants(values)]
+            check(records == expected_records, f"{attempt}: the participants are not the same as the spreadsheet's")
+            # One request per page, and one more for the empty page after the last row
+            expected_requests = 0 if attempt == "unchanged spreadsheet" else -(-len(spreadsheet) // page_rows) + 1
+            check(service.requests.count('batchGet') == expected_requests,
+                  f"{attempt}: {service.requests.count('batchGet')} batchGet requests instead of {expected_requests}")
+            print(f"{attempt}: {len(values)} rows, {service.requests.count('batchGet')} batchGet requests")
+
+    # A blank row at the end of a page: the API leaves it out, so that page comes back shorter than the others
+    blank_row_spreadsheet = spreadsheet[:page_rows - 1] + [[""] * len(spreadsheet[0])] + spreadsheet[page_rows - 1:]
+    blank_row_service = FakeSheetsService({Matchmaking.RANGE_NAME: blank_row_spreadsheet})
+    values = Matchmaking.access_spreadsheet(blank_row_service, snapshot_file=None)
+    records = [participant.record for participant in Matchmaking.read_participants(values)]
+    check(records == [participant.record for participant in Matchmaking.read_participants(blank_row_spreadsheet)],
+          f"with a blank row {page_rows}, {len(values)} rows were read instead of {len(blank_row_spreadsheet)}")
+    print(f"blank row {page_rows}: {len(values)} rows, {blank_row_service.requests.count('batchGet')} batchGet requests")
+
+    Matchmaking.REQUESTS_PER_MINUTE = Matchmaking.TOKENS_PER_MINUTE = 10 ** 12
+    gender_index = Matchmaking.GenderIndex(Matchmaking.read_participants(spreadsheet))
+    matches = [list(records) for records in Matchmaking.match_mentors(
+        gender_index.mentors, Matchmaking.get_mentor_pools(gender_index), FakeChatClient())]
+    pairs = Matchmaking.assign_pairs(matches)
+    # Old results with more rows than the new ones, that need to be cleared
+    service.tabs[Matchmaking.MATCHES_RANGE_NAME] = [["old"]] * 1000
+    service.requests = []
+    Matchmaking.write_results(matches, pairs, service)
+    written_matches = service.tabs[Matchmaking.MATCHES_RANGE_NAME][1:]
+    written_pairs = service.tabs[Matchmaking.PAIRS_RANGE_NAME][1:]
+    check(written_matches == [record.to_row() for records in matches for record in records],
+          "the matches written are not the same as the results")
+    check(written_pairs == [record.to_row() for record in pairs], "the pairs written are not the same as the results")
+    check(service.requests == ['batchClear', 'batchUpdate'], f"write requests: {', '.join(service.requests)}")
+    print(f"write: {len(written_matches)} matches and {len(written_pairs)} pairs, "
+          f"requests: {', '.join(service.requests)}")
+
+
+# A rate limiter that remembers the lowest number of requests it allowed in flight
+class RecordingRateLimiter(Matchmaking.RateLimiter):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lowest_concurrency = self.concurrency
+
+    def release(self, success):
+        super().release(success)
+        self.lowest_concurrency = min(self.lowest_concurrency, self.concurrency)
+
+
+# Send prompts at the same time to a fake client that is slow and returns 429 errors, and check that the responses
+# come back in the order of the prompts, that no request failed, that the requests in flight were limited and all
+# released, that 429 errors halved the number of requests in flight, and that the 'retry-after' header was used
+def benchmark_concurrency(num_prompts, latency, rate_limit_every, max_concurrency):
+    spreadsheet = make_synthetic_spreadsheet(num_prompts, 10)
+    gender_index = Matchmaking.GenderIndex(Matchmaking.read_participants(spreadsheet))
+    mentors = gender_index.mentors
+    prompts = [Matchmaking.prompt + Matchmaking.build_mentor_record(mentor, gender_index.mentees)
+               for mentor in mentors]
+    ai_client = FakeChatClient(latency, rate_limit_every, retry_after=0.01)
+    rate_limiter = RecordingRateLimiter(max_concurrency, 10 ** 9, 10 ** 12)
+    print(f"{num_prompts} prompts, {max_concurrency} at a time, {latency} seconds each, a 429 error every "
+          f"{rate_limit_every} requests")
+    start = time.perf_counter()
+    responses = []
+    # A request slot that is never released makes the requests wait forever, so the requests run in a thread that
+    # is given a deadline
+    sender = threading.Thread(target=lambda: responses.extend(
+        Matchmaking.get_ai_responses(prompts, ai_client, max_concurrency, rate_limiter)), daemon=True)
+    sender.start()
+    sender.join(timeout=max(10.0, 10 * num_prompts * latency))
+    if sender.is_alive():
+        print(f"  FAILED: the requests got stuck, with {rate_limiter.in_flight} in flight", flush=True)
+        # The stuck worker threads would keep the run from exiting
+        os._exit(1)
+    elapsed = time.perf_counter() - start
+    print(f"  {elapsed:.2f} seconds ({num_prompts * latency:.2f} one at a time), {ai_client.requests} requests, "
+          f"{ai_client.rate_limited} rate limited, up to {ai_client.max_in_flight} in flight, lowest concurrency "
+          f"{rate_limiter.lowest_concurrency}")
+    check(len(responses) == len(prompts), f"{len(responses)} responses for {len(prompts)} prompts")
+    for mentor, response in zip(mentors, responses):
+        check(not response.startswith("An error occurred"), f"request for {mentor.email} failed: {response}")
+        check(all(line.split(';')[1].strip() == mentor.email for line in response.split('\n')),
+              f"the response for {mentor.email} is not in its place")
+    check(rate_limiter.in_flight == 0, f"{rate_limiter.in_flight} requests still in flight")
+    check(ai_client.max_in_flight <= max_concurrency, f"{ai_client.max_in_flight} requests were in flight at once")
+    if rate_limit_every:
+        check(ai_client.rate_limited > 0, "no request was rate limited")
+        check(rate_limiter.lowest_concurrency < max_concurrency, "429 errors didn't lower the concurrency")
+        # With the exponential backoff, every retry would wait at least half of RETRY_BASE_DELAY
+        check(elapsed < ai_client.rate_limited * Matchmaking.RETRY_BASE_DELAY / 2,
+              "the retries didn't use the 'retry-after' header")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for the matching script")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    prompts_parser = subparsers.add_parser('prompts', help="time building the prompts")
+    prompts_parser.add_argument('--mentors', type=int, default=1000)
+    prompts_parser.add_argument('--mentees', type=int, default=1000)
+    prompts_parser.add_argument('--no-legacy', action='store_true', help="don't time the row by row prompt building")
+    pipeline_parser = subparsers.add_parser('pipeline', help="time the whole pipeline with a fake GPT client")
+    pipeline_parser.add_argument('--participants', type=int, nargs='+', default=[100, 1000, 10000])
+    pipeline_parser.add_argument('--latency', type=float, default=0.0, help="seconds the fake GPT takes to answer")
+    pipeline_parser.add_argument('--concurrency', type=int, help="requests in flight at once")
+    pipeline_parser.add_argument('--pack', action='store_true', help="pack mentors with the same mentees")
+    pipeline_parser.add_argument('--metrics', metavar='METRICS_FILE',
+                                 help="write the metrics of every mentor to a JSONL file")
+    batch_parser = subparsers.add_parser('batch', help="export and ingest Batch API files offline")
+    batch_parser.add_argument('--participants', type=int, default=100)
+    batch_parser.add_argument('--files', nargs=2, metavar=('REQUESTS_FILE', 'RESULTS_FILE'),
+                              help="the Batch API files to read, instead of the sample files in fixtures/")
+    sheets_parser = subparsers.add_parser('sheets', help="read and write a fake Google Sheets spreadsheet offline")
+    sheets_parser.add_argument('--participants', type=int, default=20)
+    sheets_parser.add_argument('--page-rows', type=int, default=8, help="rows per batchGet request")
+    concurrency_parser = subparsers.add_parser('concurrency', help="check sending requests at the same time")
+    concurrency_parser.add_argument('--prompts', type=int, default=40)
+    concurrency_parser.add_argument('--latency', type=float, default=0.05, help="seconds the fake GPT takes to answer")
+    concurrency_parser.add_argument('--rate-limit-every', type=int, default=7,
+                                    help="every how many requests the fake GPT returns a 429 error (0 for never)")
+    concurrency_parser.add_argument('--concurrency', type=int, default=8, help="requests in flight at once")
+    args = parser.parse_args()
+
+    if args.benchmark == 'prompts':
+        benchmark_prompts(args.mentors, args.mentees, legacy=not args.no_legacy)
+    elif args.benchmark == 'pipeline':
+        for num_participants in args.participants:
+            benchmark_pipeline(num_participants, args.latency, args.concurrency, args.metrics, args.pack)
+    elif args.benchmark == 'batch':
+        benchmark_batch(args.participants, *(args.files or []))
+    elif args.benchmark == 'sheets':
+        benchmark_sheets(args.participants, args.page_rows)
+    elif args.benchmark == 'concurrency':
+        benchmark_concurrency(args.prompts, args.latency, args.rate_limit_every, args.concurrency)